@@ -8,7 +8,7 @@ Created by Tristan Jehan and Jason Sundram.
 import os
 import dirac
 import sys
-from numpy import zeros, multiply, float32, mean, copy
+from numpy import multiply, float32
 from math import atan, pi
 from echonest.remix.audio import assemble, AudioData
 from cAction import limit, crossfade, fadein, fadeout
@@ -22,18 +22,14 @@ def rows(m):
 def make_mono(track):
     """Converts stereo tracks to mono; leaves mono tracks alone."""
     if track.data.ndim == 2:
-        mono = mean(track.data,1)
-        track.data = mono
+        track.data = track.with_channels(1).data
         track.numChannels = 1
     return track
 
 def make_stereo(track):
     """If the track is mono, doubles it. otherwise, does nothing."""
     if track.data.ndim == 1:
-        stereo = zeros((len(track.data), 2))
-        stereo[:,0] = copy(track.data)
-        stereo[:,1] = copy(track.data)
-        track.data = stereo
+        track.data = track.with_channels(2).data
         track.numChannels = 2
     return track
     
@@ -8,13 +8,13 @@ Refactoring by Ben Lacker 2009-02-11.
 Other contributions by Adam Lindsay. 
 Additional functions and cleanup by Peter Sobot on 2012-11-01.
 
-:group Base Classes: AudioAnalysis, AudioRenderable, AudioData, AudioData32
-:group Audio-plus-Analysis Classes: AudioFile, LocalAudioFile, LocalAnalysis
-:group Building Blocks: AudioQuantum, AudioSegment, AudioQuantumList, ModifiedRenderable
+:group Base Classes: AudioAnalysis, AnalysisTable, AudioRenderable, AudioData, AudioData32
+:group Audio-plus-Analysis Classes: AudioFile, LocalAudioFile, LocalAnalysis, load_many
+:group Building Blocks: AudioQuantum, AudioSegment, AudioQuantumList, ModifiedRenderable, RenderPlan, RenderCache
 :group Effects: AudioEffect, LevelDB, AmplitudeFactor, TimeTruncateFactor, TimeTruncateLength, Simultaneous
-:group Exception Classes: FileTypeError, EchoNestRemixError
+:group Exception Classes: FileTypeError, EchoNestRemixError, LoadError
 
-:group Audio helper functions: getpieces, mix, assemble, megamix
+:group Audio helper functions: getpieces, mix, assemble, megamix, wave_memmap
 :group Utility functions: _dataParser, _attributeParser, _segmentsParser
 
 .. _Analyze API: http://developer.echonest.com/
@@ -25,10 +25,9 @@ Additional functions and cleanup by Peter Sobot on 2012-11-01.
 __version__ = "$Revision: 0 $"
 # $Source$
 
-import hashlib
+import bisect
 import numpy
 import os
-import sys
 import errno
 import cPickle
 import shutil
@@ -43,25 +42,76 @@ import cStringIO
 import xml.etree.ElementTree as etree
 import xml.dom.minidom as minidom
 import weakref
+import fractions
+import threading
+import collections
+import numbers
+from multiprocessing.pool import ThreadPool
 
 from pyechonest import track
 from pyechonest.util import EchoNestAPIError
 import pyechonest.util
 import pyechonest.config as config
 
-from support.ffmpeg import ffmpeg, ffmpeg_downconvert
+from support.ffmpeg import ffmpeg, ffmpeg_downconvert, ffmpeg_pcm, ffmpeg_encode
+from support.ffmpeg import PCM_CHUNK_FRAMES
+from support.exceptionthread import ExceptionThread
 from local_db import check_and_create_local_db
 from local_db import check_db
 from local_db import save_to_local
 from local_db import get_audio_file
 from local_db import get_analysis_file
+from local_db import temp_audio_file
+from local_db import file_md5
+from local_db import file_info
 
 MP3_BITRATE = 128
 
+# Windowed `AudioData` decodes at least this many seconds of audio at a
+# time, and keeps this many decoded windows around per track.
+WINDOW_SECONDS = 10
+WINDOW_CACHE_SIZE = 16
+
+# Factor by which an `AudioData` sample buffer grows when it runs out of room.
+BUFFER_GROWTH = 1.5
+
+# Output frames computed at a time by `AudioData.resampled`, and the Kaiser
+# window parameter of its filter.
+RESAMPLE_CHUNK_FRAMES = 8192
+RESAMPLE_BETA = 5.0
+
+# Version of the binary format written by `AudioAnalysis.save`.
+ANALYSIS_FORMAT_VERSION = 1
+
+# Most bytes of rendered pieces that `RENDER_CACHE` keeps, or None for no limit.
+RENDER_CACHE_BYTES = 128 * 1024 ** 2
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+def _analysis_string(name):
+    "Help `AudioAnalysis`: a property for one of its long strings."
+    def get(self):
+        strings = self.__dict__.setdefault('_strings', {})
+        if name not in strings:
+            path = self.__dict__.get('_strings_path')
+            strings[name] = None
+            if path is not None:
+                with open(path, 'rb') as f:
+                    archive = numpy.load(f)
+                    if 'string.' + name in archive.files:
+                        strings[name] = archive['string.' + name].tostring().decode('utf-8')
+        return strings[name]
+
+    def set(self, value):
+        self.__dict__.setdefault('_strings', {})[name] = value
+    return property(get, set, doc="""
+    The %s of the track. For analyses loaded with `fromLocal` from a
+    file written by `save`, it is read from the file on first use.
+    """ % name)
+
+
 class AudioAnalysis(object):
     """
     This class uses (but does not wrap) `pyechonest.track` to allow
@@ -115,6 +165,9 @@ class AudioAnalysis(object):
                 # see if path_or_identifier is a path or an ID
                 if os.path.isfile(initializer): 
                     # read from the local analysis file
+                    if fromLocal and _is_npz(initializer):
+                        self._load(initializer)
+                        return
                     if fromLocal:
                         with open(initializer, 'rb') as f:
                             track_dict = json.loads(f.read())
@@ -187,6 +240,7 @@ class AudioAnalysis(object):
                 raise EchoNestRemixError('Could not find analysis for track!')
 
         self.source = None
+        self._tables = {}
         self._bars = None
         self._beats = None
         self._tatums = None
@@ -220,38 +274,126 @@ class AudioAnalysis(object):
         for attribute in ('end_of_fade_in', 'start_of_fade_out', 'duration', 'loudness'):
             setattr(self, attribute, getattr(self.pyechonest_track, attribute))
 
+    KINDS = ('bar', 'beat', 'tatum', 'section', 'segment')
+    STRINGS = ('synchstring', 'codestring', 'rhythmstring')
+    HEADER = ('time_signature', 'mode', 'tempo', 'key', 'end_of_fade_in',
+              'start_of_fade_out', 'duration', 'loudness', 'metadata')
+
+    synchstring = _analysis_string('synchstring')
+    codestring = _analysis_string('codestring')
+    rhythmstring = _analysis_string('rhythmstring')
+
+    _source = None
+
+    def get_source(self):
+        return self._source
+
+    def set_source(self, value):
+        self._source = value
+        AudioQuantumList._source_generation += 1
+
+    source = property(get_source, set_source, doc="""
+    The `AudioData` whose samples this analysis describes, which its quanta
+    take as their source. Setting it rebuilds the cached `sources` of
+    `AudioQuantumList`\s.
+    """)
+
+    def save(self, path):
+        """
+        Writes this analysis to `path` in a compact binary (`numpy.savez`)
+        format, which `AudioAnalysis(path, fromLocal=True)` reads back.
+        The units of each kind are stored as the typed arrays of their
+        `AnalysisTable`; the long synch, code and rhythm strings are
+        stored separately and are only read when they are used.
+        """
+        header = {'id': self.identifier,
+                  'md5': getattr(self.pyechonest_track, 'md5', None)}
+        for attribute in self.HEADER:
+            header[attribute] = getattr(self, attribute)
+        arrays = {'version': numpy.array(ANALYSIS_FORMAT_VERSION),
+                  'header': numpy.frombuffer(json.dumps(header), dtype=numpy.uint8)}
+        for kind in self.KINDS:
+            for name, column in self.table(kind).to_arrays().items():
+                arrays[kind + '.' + name] = column
+        for name in self.STRINGS:
+            value = getattr(self, name)
+            if value:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                arrays['string.' + name] = numpy.frombuffer(value, dtype=numpy.uint8)
+        with open(path, 'wb') as f:
+            numpy.savez(f, **arrays)
+
+    def _load(self, path):
+        "Help `__init__` read an analysis written by `save`."
+        with open(path, 'rb') as f:
+            archive = numpy.load(f)
+            version = int(archive['version'])
+            if version > ANALYSIS_FORMAT_VERSION:
+                raise EchoNestRemixError('Analysis file %s has unsupported version %d' % (path, version))
+            header = json.loads(archive['header'].tostring())
+            columns = dict((kind, {}) for kind in self.KINDS)
+            for member in archive.files:
+                kind, _, name = member.partition('.')
+                if kind in columns:
+                    columns[kind][name] = archive[member]
+        self.pyechonest_track = None
+        self.source = None
+        self._tables = dict((kind, AnalysisTable.from_arrays(kind, columns[kind]))
+                            for kind in self.KINDS)
+        self._bars = None
+        self._beats = None
+        self._tatums = None
+        self._sections = None
+        self._segments = None
+        self._strings_path = path
+        self.identifier = header['id']
+        for attribute in self.HEADER:
+            setattr(self, attribute, header.get(attribute))
+
+    def table(self, kind):
+        """
+        Returns the `AnalysisTable` holding every unit of the given `kind`
+        ("bar", "beat", "tatum", "section" or "segment") as arrays. Tables
+        are built on first use and cached.
+        """
+        if kind not in self._tables:
+            nodes = getattr(self.pyechonest_track, kind + 's')
+            self._tables[kind] = AnalysisTable.from_nodes(kind, nodes)
+        return self._tables[kind]
+
     @property
     def bars(self):
         if self._bars is None:
-            self._bars = _dataParser('bar', self.pyechonest_track.bars)
+            self._bars = self.table('bar').quanta()
             self._bars.attach(self)
         return self._bars
 
     @property
     def beats(self):
         if self._beats is None:
-            self._beats = _dataParser('beat', self.pyechonest_track.beats)
+            self._beats = self.table('beat').quanta()
             self._beats.attach(self)
         return self._beats
 
     @property
     def tatums(self):
         if self._tatums is None:
-            self._tatums = _dataParser('tatum', self.pyechonest_track.tatums)
+            self._tatums = self.table('tatum').quanta()
             self._tatums.attach(self)
         return self._tatums
 
     @property
     def sections(self):
         if self._sections is None:
-            self._sections = _attributeParser('section', self.pyechonest_track.sections)
+            self._sections = self.table('section').quanta()
             self._sections.attach(self)
         return self._sections
 
     @property
     def segments(self):
         if self._segments is None:
-            self._segments = _segmentsParser(self.pyechonest_track.segments)
+            self._segments = self.table('segment').quanta()
             self._segments.attach(self)
         return self._segments
 
@@ -314,6 +456,14 @@ class AudioRenderable(object):
     def sources(self):
         return set([self.source])
 
+    def _compile(self, plan, start):
+        """
+        Adds this object, rendered at `start` seconds, to a `RenderPlan`.
+        Objects that the plan can't see into are rendered by their own
+        `render` when the plan is run.
+        """
+        plan.nodes.append((self, start))
+
     def encode(self, filename):
         """
         Shortcut function that takes care of the need to obtain an `AudioData`
@@ -336,7 +486,7 @@ class AudioData(AudioRenderable):
 
     .. _numpy.array: http://docs.scipy.org/doc/numpy/reference/generated/numpy.array.html
     """
-    def __init__(self, filename=None, ndarray=None, shape=None, sampleRate=None, numChannels=None, defer=False, verbose=True):
+    def __init__(self, filename=None, ndarray=None, shape=None, sampleRate=None, numChannels=None, defer=False, verbose=True, stream=False, memmap=False, windowed=False, copy=True):
         """
         Given an input `ndarray`, import the sample values and shape
         (if none is specified) of the input `numpy.array`.
@@ -351,37 +501,66 @@ class AudioData(AudioRenderable):
         :param shape: a tuple of array dimensions
         :param sampleRate: sample rate, in Hz
         :param numChannels: number of channels
+        :param stream: if True, decode by reading ffmpeg's PCM output
+            straight into memory instead of through a temporary wave file
+        :param memmap: if True and `filename` is a 44.1kHz stereo wave
+            file, `data` becomes a read-only `numpy.memmap` over its
+            samples rather than a copy in memory
+        :param windowed: if True, the file is never decoded as a whole:
+            each slice decodes only a window of audio around it, and the
+            most recently used windows are cached. Implies `defer`.
+        :param copy: if False (and no `shape` is given), an int16 `ndarray`
+            becomes `data` as it is, rather than being copied
 
         .. _numpy.array: http://docs.scipy.org/doc/numpy/reference/generated/numpy.array.html
         """
         self.verbose = verbose
-        self.defer = defer
+        self.defer = defer or windowed
+        self.stream = stream
+        self.memmap = memmap
+        self.windowed = windowed
         self.filename = filename
         self.sampleRate = sampleRate
         self.numChannels = numChannels
         self.convertedfile = None
         self.endindex = 0
+        self._buffer = None
+        self._windows = collections.OrderedDict()
+        if windowed:
+            # Windows are decoded to these settings, so they are known up front.
+            self.sampleRate = sampleRate or 44100
+            self.numChannels = numChannels or 2
         if shape is None and isinstance(ndarray, numpy.ndarray) and not self.defer:
-            self.data = numpy.zeros(ndarray.shape, dtype=numpy.int16)
+            self.data = numpy.array(ndarray, dtype=numpy.int16, copy=copy)
+            self.endindex = len(ndarray)
         elif shape is not None and not self.defer:
             self.data = numpy.zeros(shape, dtype=numpy.int16)
+            if ndarray is not None:
+                self.endindex = len(ndarray)
+                self.data[0:self.endindex] = ndarray
         elif not self.defer and self.filename:
             self.data = None
             self.load()
         else:
             self.data = None
-        if ndarray is not None and self.data is not None:
-            self.endindex = len(ndarray)
-            self.data[0:self.endindex] = ndarray
 
     def load(self):
         if isinstance(self.data, numpy.ndarray):
             return
         temp_file_handle = None
         if self.filename.lower().endswith(".wav") and (self.sampleRate, self.numChannels) == (44100, 2):
+            if self.memmap:
+                self.data = wave_memmap(self.filename)
+                self.endindex = len(self.data)
+                return
             file_to_read = self.filename
         elif self.convertedfile:
             file_to_read = self.convertedfile
+        elif self.stream:
+            self.data, self.sampleRate, self.numChannels = ffmpeg_pcm(self.filename,
+                    numChannels=self.numChannels, sampleRate=self.sampleRate, verbose=self.verbose)
+            self.endindex = len(self.data)
+            return
         else:
             temp_file_handle, self.convertedfile = tempfile.mkstemp(".wav")
             self.sampleRate, self.numChannels = ffmpeg(self.filename, self.convertedfile, overwrite=True,
@@ -411,8 +590,16 @@ class AudioData(AudioRenderable):
         is a time offset float or an integer sample number) or a slice if
         the index is an `AudioQuantum` (or quacks like one).
         """
-        if not isinstance(self.data, numpy.ndarray) and self.defer:
+        if not isinstance(self.data, numpy.ndarray) and self.defer and not self.windowed:
             self.load()
+        index = self._index(index)
+        if isinstance(index, slice):
+            return self.getslice(index)
+        else:
+            return self.getsample(index)
+
+    def _index(self, index):
+        "Help `__getitem__` turn time offsets and `AudioQuantum`\s into indices"
         if isinstance(index, float):
             index = int(index * self.sampleRate)
         elif hasattr(index, "start") and hasattr(index, "duration"):
@@ -423,21 +610,143 @@ class AudioData(AudioRenderable):
                  hasattr(index.stop, "duration") and
                  hasattr(index.stop, "start")):
                 index = slice(index.start.start, index.stop.start + index.stop.duration)
+        return index
 
-        if isinstance(index, slice):
-            return self.getslice(index)
-        else:
-            return self.getsample(index)
+    def view(self, index):
+        """
+        Like `__getitem__` for a slice or an `AudioQuantum`, but returns
+        an `AudioData` whose `data` is a read-only view of this one's
+        samples rather than a copy of them. Anything that writes to the
+        view (`append`, `add_at`, effects...) copies it first.
+        """
+        index = self._index(index)
+        if not isinstance(index, slice):
+            raise TypeError("view() takes a slice or an AudioQuantum, not %r" % (index,))
+        return self.getslice(index, copy=False)
 
-    def getslice(self, index):
-        "Help `__getitem__` return a new AudioData for a given slice"
-        if not isinstance(self.data, numpy.ndarray) and self.defer:
-            self.load()
+    def getslice(self, index, copy=True):
+        """
+        Help `__getitem__` return a new AudioData for a given slice. If
+        `copy` is False, the new AudioData is a read-only view.
+        """
         if isinstance(index.start, float):
             index = slice(int(index.start * self.sampleRate),
                             int(index.stop * self.sampleRate), index.step)
-        return AudioData(None, self.data[index], sampleRate=self.sampleRate,
-                            numChannels=self.numChannels, defer=False)
+        if not isinstance(self.data, numpy.ndarray) and self.defer:
+            if (self.windowed and index.step in (None, 1)
+                    and (index.start or 0) >= 0
+                    and (index.stop is None or index.stop >= 0)):
+                return self._like(self.getwindow(index.start or 0, index.stop), copy)
+            self.load()
+        return self._like(self.data[index], copy)
+
+    def _like(self, ndarray, copy=True, sampleRate=None, numChannels=None):
+        """
+        Wraps `ndarray` in a new `AudioData` (or `AudioData32`) with this
+        one's sample rate and channels, unless others are given. If `copy`
+        is False and `ndarray` is adopted as it is, it is marked read-only,
+        so that writers go through `ensure_writable` and never touch this
+        one's samples.
+        """
+        kind = AudioData32 if isinstance(self, AudioData32) else AudioData
+        piece = kind(None, ndarray, sampleRate=sampleRate or self.sampleRate,
+                        numChannels=numChannels or self.numChannels, defer=False, copy=copy)
+        if not copy and piece.data is ndarray:
+            piece.data.flags.writeable = False
+        return piece
+
+    def _adopt(self, ndarray, sampleRate=None, numChannels=None):
+        """
+        Like `_like` without copying, for a new `ndarray` that nothing else
+        holds: it is adopted as it is, and stays writable.
+        """
+        kind = AudioData32 if isinstance(self, AudioData32) else AudioData
+        return kind(None, ndarray, sampleRate=sampleRate or self.sampleRate,
+                    numChannels=numChannels or self.numChannels, defer=False, copy=False)
+
+    def ensure_writable(self):
+        """
+        Replaces `data` with a private, writable copy if it is read-only:
+        a view from `view`, or a memory-mapped file.
+        """
+        if isinstance(self.data, numpy.ndarray) and not self.data.flags.writeable:
+            self.data = numpy.array(self.data)
+
+    def with_channels(self, num_channels):
+        """
+        Returns a new `AudioData` of the same type of samples, converted to
+        `num_channels` channels: upmixing repeats the channels in turn (so
+        mono becomes identical left and right), and downmixing averages
+        the channels that fold onto each output channel.
+        """
+        if not isinstance(self.data, numpy.ndarray):
+            self.load()
+        channels = self.encoded_channels()
+        if channels == num_channels:
+            return self._like(self.data)
+        mixing = numpy.zeros((channels, num_channels))
+        if channels < num_channels:
+            for j in xrange(num_channels):
+                mixing[j % channels, j] = 1.
+        else:
+            for i in xrange(channels):
+                mixing[i, i % num_channels] = 1.
+            mixing /= mixing.sum(axis=0)
+        source = self.data.reshape((len(self.data), channels))
+        shape = (len(self.data), num_channels) if num_channels > 1 else (len(self.data),)
+        out = numpy.empty(shape, dtype=self.data.dtype)
+        for start in xrange(0, len(source), PCM_CHUNK_FRAMES):
+            stop = start + PCM_CHUNK_FRAMES
+            mixed = numpy.dot(source[start:stop], mixing)
+            out[start:stop] = _to_dtype(mixed.reshape(out[start:stop].shape), out.dtype)
+        return self._adopt(out, numChannels=num_channels)
+
+    def resampled(self, rate):
+        """
+        Returns a new `AudioData` of the same type of samples, resampled
+        to `rate` samples per second by a polyphase filter (a Kaiser-windowed
+        sinc), without decoding the source again.
+        """
+        if not isinstance(self.data, numpy.ndarray):
+            self.load()
+        rate = int(rate)
+        if rate == self.sampleRate:
+            return self._like(self.data)
+        gcd = fractions.gcd(rate, int(self.sampleRate))
+        up, down = rate // gcd, int(self.sampleRate) // gcd
+
+        # A low-pass filter at the lower of the two Nyquist rates, at the
+        # upsampled rate, and split into its `up` phases.
+        half_len = 10 * max(up, down)
+        taps = numpy.arange(-half_len, half_len + 1, dtype=numpy.float64)
+        h = numpy.sinc(taps / max(up, down)) * numpy.kaiser(len(taps), RESAMPLE_BETA)
+        h *= up / h.sum()
+        width = -(-len(h) // up)
+        bank = numpy.zeros((up, width))
+        for phase in xrange(up):
+            phase_taps = h[phase::up]
+            bank[phase, :len(phase_taps)] = phase_taps
+
+        data = self.data
+        frames = -(-len(data) * up // down)
+        out = numpy.empty((frames,) + data.shape[1:], dtype=data.dtype)
+        for start in xrange(0, frames, RESAMPLE_CHUNK_FRAMES):
+            k = numpy.arange(start, min(start + RESAMPLE_CHUNK_FRAMES, frames))
+            t = k * down + half_len
+            newest = t // up
+            # Output k sums x[newest - i] * bank[t % up, i] over i.
+            lo = newest[0] - width + 1
+            hi = newest[-1] + 1
+            window = numpy.zeros((hi - lo,) + data.shape[1:])
+            window[max(0, -lo):max(0, min(hi, len(data)) - lo)] = data[max(0, lo):max(0, min(hi, len(data)))]
+            gathered = window[newest[:, numpy.newaxis] - numpy.arange(width) - lo]
+            weights = bank[t % up]
+            if data.ndim == 1:
+                y = (gathered * weights).sum(axis=1)
+            else:
+                y = numpy.einsum('ki,kic->kc', weights, gathered)
+            out[k[0]:k[-1] + 1] = _to_dtype(y, out.dtype)
+        return self._adopt(out, sampleRate=rate)
 
     def getsample(self, index):
         """
@@ -445,6 +754,8 @@ class AudioData(AudioRenderable):
         sample index)
         """
         if not isinstance(self.data, numpy.ndarray) and self.defer:
+            if self.windowed and isinstance(index, int) and index >= 0:
+                return self.getwindow(index, index + 1)[0]
             self.load()
         if isinstance(index, int):
             return self.data[index]
@@ -452,44 +763,132 @@ class AudioData(AudioRenderable):
             #let the numpy array interface be clever
             return AudioData(None, self.data[index], defer=False)
 
+    def getwindow(self, start, stop):
+        """
+        Returns the samples of a windowed `AudioData` between the frame
+        indices `start` and `stop` (or the end of the file, if `stop` is
+        None). Only a window of at least `WINDOW_SECONDS` around them is
+        decoded, and the last `WINDOW_CACHE_SIZE` windows are kept, so
+        neighbouring slices rarely need to decode anything.
+        """
+        for wstart, (samples, eof) in self._windows.items():
+            if wstart <= start and (eof or (stop is not None and stop <= wstart + len(samples))):
+                # Mark as most recently used.
+                self._windows[wstart] = self._windows.pop(wstart)
+                return samples[start - wstart:None if stop is None else stop - wstart]
+        frames = None
+        if stop is not None:
+            frames = max(stop - start, WINDOW_SECONDS * self.sampleRate)
+        samples = self._decode_window(start, frames)
+        self._windows[start] = (samples, frames is None or len(samples) < frames)
+        while len(self._windows) > WINDOW_CACHE_SIZE:
+            self._windows.popitem(last=False)
+        return samples[:None if stop is None else stop - start]
+
+    def _decode_window(self, start, frames):
+        "Decodes `frames` frames (or all remaining, if None) from frame `start`."
+        if self.filename.lower().endswith(".wav"):
+            w = wave.open(self.filename, 'r')
+            try:
+                if (w.getframerate(), w.getnchannels(), w.getsampwidth()) == (self.sampleRate, self.numChannels, 2):
+                    w.setpos(min(start, w.getnframes()))
+                    raw = w.readframes(w.getnframes() if frames is None else frames)
+                    samples = numpy.frombuffer(raw, dtype="<h").astype(numpy.int16)
+                    if self.numChannels > 1:
+                        samples = samples.reshape((-1, self.numChannels))
+                    return samples
+            finally:
+                w.close()
+        # Ask for a frame more than needed, so that rounding in ffmpeg's
+        # duration handling never looks like the end of the file.
+        samples = ffmpeg_pcm(self.filename, numChannels=self.numChannels,
+                             sampleRate=self.sampleRate, verbose=self.verbose,
+                             offset=float(start) / self.sampleRate,
+                             duration=None if frames is None else float(frames + 1) / self.sampleRate)[0]
+        return samples[:frames]
+
+    def capacity(self):
+        """
+        Returns the number of frames that `data` can grow to (through
+        `pad_with_zeros`, `append`, `add_at` or `sum`) without reallocating.
+        """
+        buf = getattr(self, '_buffer', None)
+        if (buf is not None and self.data is not None and self.data.base is buf
+                and self.data.ctypes.data == buf.ctypes.data
+                and self.data.strides == buf.strides):
+            return len(buf)
+        return len(self.data)
+
+    def reserve(self, num_samples):
+        """
+        Makes room for at least `num_samples` frames, so that growing `data`
+        up to that length does not reallocate or copy it. `data` itself,
+        and so `len`\(), is unchanged.
+        """
+        if self.capacity() < num_samples:
+            buf = numpy.zeros((num_samples,) + self.data.shape[1:], dtype=self.data.dtype)
+            buf[:len(self.data)] = self.data
+            self._buffer = buf
+            self.data = buf[:len(self.data)]
+
     def pad_with_zeros(self, num_samples):
+        """
+        Extends `data` by `num_samples` frames of silence. Storage grows
+        geometrically, so repeated padding takes amortized linear time.
+        """
         if num_samples > 0:
-            if self.numChannels == 1:
-                extra_shape = (num_samples,)
-            else:
-                extra_shape = (num_samples, self.numChannels)
-            self.data = numpy.append(self.data,
-                                     numpy.zeros(extra_shape, dtype=numpy.int16), axis=0)
+            length = len(self.data)
+            capacity = self.capacity()
+            if capacity < length + num_samples:
+                self.reserve(max(length + num_samples, int(capacity * BUFFER_GROWTH)))
+            self.data = self._buffer[:length + num_samples]
+            self.data[length:] = 0
 
     def append(self, another_audio_data):
         "Appends the input to the end of this `AudioData`."
         extra = len(another_audio_data.data) - (len(self.data) - self.endindex)
         self.pad_with_zeros(extra)
+        self.ensure_writable()
         self.data[self.endindex : self.endindex + len(another_audio_data)] += another_audio_data.data
+        self._update_peak(self.endindex, self.endindex + len(another_audio_data))
         self.endindex += another_audio_data.endindex
 
     def sum(self, another_audio_data):
         extra = len(another_audio_data.data) - len(self.data)
         self.pad_with_zeros(extra)
+        self.ensure_writable()
         compare_limit = min(len(another_audio_data.data), len(self.data)) - 1
         self.data[: compare_limit] += another_audio_data.data[: compare_limit]
+        self._update_peak(0, compare_limit)
 
     def add_at(self, time, another_audio_data):
         """
         Adds the input `another_audio_data` to this `AudioData` 
-        at the `time` specified in seconds. If `another_audio_data` has fewer channels than
-        this `AudioData`, the `another_audio_data` will be resampled to match.
-        In this case, this method will modify `another_audio_data`.
+        at the `time` specified in seconds. If `another_audio_data` has a different
+        sample rate or number of channels than this `AudioData`, a converted copy
+        of it (see `resampled` and `with_channels`) is added instead.
 
         """
+        another_audio_data = self._conform(another_audio_data)
         offset = int(time * self.sampleRate)
         extra = offset + len(another_audio_data.data) - len(self.data)
         self.pad_with_zeros(extra)
-        if another_audio_data.numChannels < self.numChannels:
-            # Resample another_audio_data
-            another_audio_data.data = numpy.repeat(another_audio_data.data, self.numChannels).reshape(len(another_audio_data), self.numChannels)
-            another_audio_data.numChannels = self.numChannels
+        self.ensure_writable()
         self.data[offset : offset + len(another_audio_data.data)] += another_audio_data.data 
+        self._update_peak(offset, offset + len(another_audio_data.data))
+
+    def _conform(self, another_audio_data):
+        "Help `add_at`: `another_audio_data`, at this one's sample rate and channels."
+        if (another_audio_data.sampleRate and self.sampleRate and
+                another_audio_data.sampleRate != self.sampleRate):
+            another_audio_data = another_audio_data.resampled(self.sampleRate)
+        if another_audio_data.encoded_channels() != self.encoded_channels():
+            another_audio_data = another_audio_data.with_channels(self.encoded_channels())
+        return another_audio_data
+
+    def _update_peak(self, start, stop):
+        "Called after `append`, `sum` and `add_at` add into `data[start:stop]`."
+        pass
 
     def __len__(self):
         if self.data is not None:
@@ -511,40 +910,9 @@ class AudioData(AudioRenderable):
             mp3 = False
         else:
             mp3 = True
-        if mp3:
-            foo, tempfilename = tempfile.mkstemp(".wav")
-            os.close(foo)
-        else:
-            tempfilename = filename
-        fid = open(tempfilename, 'wb')
-        # Based on Scipy svn
-        # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
-        fid.write('RIFF')
-        fid.write(struct.pack('<i', 0))  # write a 0 for length now, we'll go back and add it later
-        fid.write('WAVE')
-        # fmt chunk
-        fid.write('fmt ')
-        if self.data.ndim == 1:
-            noc = 1
-        else:
-            noc = self.data.shape[1]
-        bits = self.data.dtype.itemsize * 8
-        sbytes = self.sampleRate * (bits / 8) * noc
-        ba = noc * (bits / 8)
-        fid.write(struct.pack('<ihHiiHH', 16, 1, noc, self.sampleRate, sbytes, ba, bits))
-        # data chunk
-        fid.write('data')
-        fid.write(struct.pack('<i', self.data.nbytes))
-        self.data.tofile(fid)
-        # Determine file size and place it in correct
-        # position at start of the file.
-        size = fid.tell()
-        fid.seek(4)
-        fid.write(struct.pack('<i', size - 8))
-        fid.close()
         if not mp3:
-            return tempfilename
-        # now convert it to mp3
+            self.write_wave(filename)
+            return filename
         if not filename.lower().endswith('.mp3'):
             filename = filename + '.mp3'
         try:
@@ -553,18 +921,58 @@ class AudioData(AudioRenderable):
             bitRate = 128
 
         try:
-            ffmpeg(tempfilename, filename, bitRate=bitRate, verbose=self.verbose)
+            ffmpeg_encode(self.pcm_chunks(), filename, numChannels=self.encoded_channels(),
+                          sampleRate=self.sampleRate, bitRate=bitRate, verbose=self.verbose)
         except:
-            log.warning("Error converting from %s to %s", tempfilename, filename)
-
-        if tempfilename != filename:
-            if self.verbose:
-                log.warning(sys.stderr, "Deleting: %s", tempfilename)
-            os.remove(tempfilename)
+            log.warning("Error converting to %s", filename)
         return filename
 
+    def encoded_channels(self):
+        "Number of channels that `encode` writes."
+        if self.data.ndim == 1:
+            return 1
+        return self.data.shape[1]
+
+    def pcm_chunks(self, frames=PCM_CHUNK_FRAMES):
+        """
+        Yields the sample data as successive 16-bit arrays of at most
+        `frames` frames each, as written by `encode`.
+        """
+        for i in xrange(0, len(self.data), frames):
+            chunk = self.data[i:i + frames]
+            if chunk.dtype != numpy.int16:
+                chunk = chunk.astype(numpy.int16)
+            yield chunk
+
+    def write_wave(self, filename):
+        """
+        Writes the 16-bit PCM produced by `pcm_chunks` to a wave file
+        at `filename`, a chunk at a time.
+        """
+        noc = self.encoded_channels()
+        datasize = len(self.data) * noc * 2
+        fid = open(filename, 'wb')
+        try:
+            # Based on Scipy svn
+            # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
+            fid.write('RIFF')
+            fid.write(struct.pack('<i', datasize + 36))
+            fid.write('WAVE')
+            # fmt chunk
+            fid.write('fmt ')
+            fid.write(struct.pack('<ihHiiHH', 16, 1, noc, self.sampleRate,
+                                  self.sampleRate * 2 * noc, noc * 2, 16))
+            # data chunk
+            fid.write('data')
+            fid.write(struct.pack('<i', datasize))
+            for chunk in self.pcm_chunks():
+                fid.write(numpy.ascontiguousarray(chunk, dtype="<h").tostring())
+        finally:
+            fid.close()
+
     def unload(self):
         self.data = None
+        self._windows.clear()
         if self.convertedfile:
             if self.verbose:
                 log.warning("Deleting: %s", self.convertedfile)
@@ -581,38 +989,114 @@ class AudioData(AudioRenderable):
 
     @property
     def duration(self):
+        if self.data is None and self.filename:
+            # Not decoded (or only decoded in windows), so go by the file.
+            return self.info().duration
         return float(self.endindex) / self.sampleRate
 
+    def info(self):
+        """
+        Returns the `MediaInfo` of `filename`: its duration, sample rate,
+        number of channels and so on, as probed from the file without
+        decoding it. Probes are remembered in the local db.
+        """
+        if getattr(self, '_info', None) is None:
+            self._info = file_info(self.filename)
+        return self._info
+
     @property
     def source(self):
         return self
 
+    def __getstate__(self):
+        """
+        Leaves out spare buffer capacity and decoded windows when pickling.
+        """
+        dictclone = self.__dict__.copy()
+        dictclone['_buffer'] = None
+        dictclone['_windows'] = collections.OrderedDict()
+        return dictclone
+
 
 class AudioData32(AudioData):
     """A 32-bit variant of AudioData, intended for data collection on
-    audio rendering with headroom."""
-    def __init__(self, filename=None, ndarray = None, shape=None, sampleRate=None, numChannels=None, defer=False, verbose=True):
+    audio rendering with headroom.
+
+    It keeps track of the peak of its data as `append`, `sum` and `add_at`
+    add to it, so that normalizing it does not need another pass over
+    the data; assigning to `data` makes the peak unknown again. Code that
+    raises samples in place in `data` by other means should set `_peak`
+    to None.
+    """
+    _peak = None
+
+    def _get_data(self):
+        return self.__dict__.get('_data')
+
+    def _set_data(self, value):
+        self.__dict__['_data'] = value
+        self.__dict__['_peak'] = None
+
+    data = property(_get_data, _set_data)
+
+    def __init__(self, filename=None, ndarray = None, shape=None, sampleRate=None, numChannels=None, defer=False, verbose=True, stream=False, copy=True):
         """
         Special form of AudioData to allow for headroom when collecting samples.
         """
         self.verbose = verbose
         self.defer = defer
+        self.stream = stream
+        self.windowed = False
         self.filename = filename
         self.sampleRate = sampleRate
         self.numChannels = numChannels
         self.convertedfile = None
+        self.endindex = 0
+        self._buffer = None
+        self._windows = collections.OrderedDict()
         if shape is None and isinstance(ndarray, numpy.ndarray) and not self.defer:
-            self.data = numpy.zeros(ndarray.shape, dtype=numpy.int32)
+            self.data = numpy.array(ndarray, dtype=numpy.int32, copy=copy)
+            self.endindex = len(ndarray)
         elif shape is not None and not self.defer:
             self.data = numpy.zeros(shape, dtype=numpy.int32)
+            if ndarray is not None:
+                self.endindex = len(ndarray)
+                self.data[0:self.endindex] = ndarray
+            else:
+                self._peak = 0
         elif not self.defer and self.filename:
+            self.data = None
             self.load()
         else:
             self.data = None
-        self.endindex = 0
-        if ndarray is not None and self.data is not None:
-            self.endindex = len(ndarray)
-            self.data[0:self.endindex] = ndarray
+
+    def peak(self):
+        "Returns the largest absolute sample value in `data`."
+        if self._peak is None:
+            self._peak = self._region_peak(0, len(self.data))
+        return self._peak
+
+    def _region_peak(self, start, stop):
+        region = self.data[start:stop]
+        if not region.size:
+            return 0
+        return max(int(region.max()), -int(region.min()))
+
+    def _update_peak(self, start, stop):
+        if self._peak is not None:
+            self._peak = max(self._peak, self._region_peak(start, stop))
+
+    def reserve(self, num_samples):
+        # Moving the data to a bigger buffer leaves the peak as it is.
+        peak = self._peak
+        AudioData.reserve(self, num_samples)
+        self._peak = peak
+
+    def pad_with_zeros(self, num_samples):
+        # As does padding it with silence.
+        peak = self._peak
+        AudioData.pad_with_zeros(self, num_samples)
+        self._peak = peak
 
     def load(self):
         if isinstance(self.data, numpy.ndarray):
@@ -622,6 +1106,12 @@ class AudioData32(AudioData):
             file_to_read = self.filename
         elif self.convertedfile:
             file_to_read = self.convertedfile
+        elif self.stream:
+            self.data, self.sampleRate, self.numChannels = ffmpeg_pcm(self.filename,
+                    numChannels=self.numChannels, sampleRate=self.sampleRate,
+                    verbose=self.verbose, dtype=numpy.int32)
+            self.endindex = len(self.data)
+            return
         else:
             temp_file_handle, self.convertedfile = tempfile.mkstemp(".wav")
             self.sampleRate, self.numChannels = ffmpeg(self.filename, self.convertedfile, overwrite=True,
@@ -649,78 +1139,104 @@ class AudioData32(AudioData):
         """
         Outputs an MP3 or WAVE file to `filename`.
         Format is determined by `mp3` parameter.
+        The data is normalized to 16 bits one chunk at a time as it is written.
         """
-        normalized = self.normalized()
-        temp_file_handle = None
         if not mp3 and filename.lower().endswith('.wav'):
             mp3 = False
         else:
             mp3 = True
-        if mp3:
-            temp_file_handle, tempfilename = tempfile.mkstemp(".wav")
-        else:
-            tempfilename = filename
-        fid = open(tempfilename, 'wb')
-        # Based on Scipy svn
-        # http://projects.scipy.org/pipermail/scipy-svn/2007-August/001189.html
-        fid.write('RIFF')
-        fid.write(struct.pack('<i', 0))  # write a 0 for length now, we'll go back and add it later
-        fid.write('WAVE')
-        # fmt chunk
-        fid.write('fmt ')
-        if normalized.ndim == 1:
-            noc = 1
-        else:
-            noc = normalized.shape[1]
-        bits = normalized.dtype.itemsize * 8
-        sbytes = self.sampleRate * (bits / 8) * noc
-        ba = noc * (bits / 8)
-        fid.write(struct.pack('<ihHiiHH', 16, 1, noc, self.sampleRate, sbytes, ba, bits))
-        # data chunk
-        fid.write('data')
-        fid.write(struct.pack('<i', normalized.nbytes))
-        normalized.tofile(fid)
-        # Determine file size and place it in correct
-        # position at start of the file.
-        size = fid.tell()
-        fid.seek(4)
-        fid.write(struct.pack('<i', size - 8))
-        fid.close()
         if not mp3:
-            return tempfilename
-        # now convert it to mp3
+            self.write_wave(filename)
+            return filename
         if not filename.lower().endswith('.mp3'):
             filename = filename + '.mp3'
         try:
             bitRate = MP3_BITRATE
         except NameError:
             bitRate = 128
-        ffmpeg(tempfilename, filename, bitRate=bitRate, verbose=self.verbose)
-        if tempfilename != filename:
-            if self.verbose:
-                log.info("Deleting: %s", tempfilename)
-            os.remove(tempfilename)
-        if temp_file_handle is not None:
-            os.close(temp_file_handle)
+        ffmpeg_encode(self.pcm_chunks(), filename, numChannels=self.encoded_channels(),
+                      sampleRate=self.sampleRate, bitRate=bitRate, verbose=self.verbose)
         return filename
 
-    def normalized(self):
-        """Return to 16-bit for encoding."""
-        factor = 32767.0 / numpy.max(numpy.absolute(self.data.flatten()))
+    def normalization_factor(self):
+        """
+        Returns the gain that `normalized` applies to bring the data into
+        16-bit range, or None if the data already fits.
+        """
+        peak = self.peak()
+        if not peak:
+            return None
+        factor = 32767.0 / peak
         # If the max was 32768, don't bother scaling:
         if factor < 1.000031:
-            return (self.data * factor).astype(numpy.int16)
-        else:
-            return self.data.astype(numpy.int16)
+            return factor
+        return None
 
-    def pad_with_zeros(self, num_samples):
-        if num_samples > 0:
-            if self.numChannels == 1:
-                extra_shape = (num_samples,)
+    def pcm_chunks(self, frames=PCM_CHUNK_FRAMES):
+        """
+        Yields normalized 16-bit arrays of at most `frames` frames each,
+        without making a full-size copy of the data.
+        """
+        factor = self.normalization_factor()
+        for i in xrange(0, len(self.data), frames):
+            chunk = self.data[i:i + frames]
+            if factor is not None:
+                chunk = chunk * factor
+            yield chunk.astype(numpy.int16)
+
+    def normalized(self):
+        """Return to 16-bit for encoding."""
+        out = numpy.empty(self.data.shape, dtype=numpy.int16)
+        start = 0
+        for chunk in self.pcm_chunks():
+            out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        return out
+
+def wave_memmap(filename):
+    """
+    Returns a read-only `numpy.memmap` over the sample data of a 16-bit PCM
+    wave file, shaped like `AudioData.data`. Only the pages that are
+    actually sliced are ever read from disk.
+    """
+    with open(filename, 'rb') as f:
+        riff, size, wave_id = struct.unpack('<4si4s', f.read(12))
+        if riff != 'RIFF' or wave_id != 'WAVE':
+            raise FileTypeError(filename, "Not a RIFF/WAVE file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise FileTypeError(filename, "No data chunk in wave file")
+            chunk_id, length = struct.unpack('<4sI', header)
+            if chunk_id == 'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(length - 16 + (length & 1), os.SEEK_CUR)
+            elif chunk_id == 'data':
+                offset = f.tell()
+                break
             else:
-                extra_shape = (num_samples, self.numChannels)
-            self.data = numpy.append(self.data,
-                                     numpy.zeros(extra_shape, dtype=numpy.int32), axis=0)
+                f.seek(length + (length & 1), os.SEEK_CUR)
+    if fmt is None or fmt[0] != 1 or fmt[5] != 16:
+        raise FileTypeError(filename, "Only 16-bit PCM wave files can be mapped")
+    numChannels = fmt[1]
+    # Streamed wave files sometimes carry a bogus data length.
+    length = min(length, os.path.getsize(filename) - offset)
+    numFrames = length // (2 * numChannels)
+    if numChannels > 1:
+        shape = (numFrames, numChannels)
+    else:
+        shape = (numFrames,)
+    return numpy.memmap(filename, dtype="<h", mode='r', offset=offset, shape=shape)
+
+
+def _to_dtype(samples, dtype):
+    "Rounds and clips float `samples` into the range of an integer `dtype`."
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype)
+        samples = numpy.clip(numpy.rint(samples), info.min, info.max)
+    return samples.astype(dtype)
+
 
 def getpieces(audioData, segs):
     """
@@ -734,9 +1250,8 @@ def getpieces(audioData, segs):
         as slices or indices for an `AudioData`
     """
 
-    # Ensure that we have data
-    if not audioData.data.all() or audioData.defer:
-        audioData.data = None
+    # Ensure that we have data (windowed sources decode each piece on demand)
+    if not isinstance(audioData.data, numpy.ndarray) and not audioData.windowed:
         audioData.load()
 
     dur = 0
@@ -745,24 +1260,53 @@ def getpieces(audioData, segs):
     # if I wanted to add some padding to the length, I'd do it here
 
     #determine shape of new array
-    if len(audioData.data.shape) > 1:
-        newshape = (dur, audioData.data.shape[1])
+    if audioData.data is None:
+        newchans = audioData.numChannels
+    elif len(audioData.data.shape) > 1:
         newchans = audioData.data.shape[1]
     else:
-        newshape = (dur,)
         newchans = 1
+    if newchans > 1:
+        newshape = (dur, newchans)
+    else:
+        newshape = (dur,)
 
     #make accumulator segment
     newAD = AudioData(shape=newshape, sampleRate=audioData.sampleRate,
                     numChannels=newchans, defer=False, verbose=audioData.verbose)
 
-    #concatenate segs to the new segment
+    #concatenate segs to the new segment, a run of back-to-back segs at a time
+    run = None
     for s in segs:
-        newAD.append(audioData[s])
+        frames = _frames(audioData, s)
+        if run is not None and frames is not None and frames.start == run.stop:
+            run = slice(run.start, frames.stop)
+            continue
+        if run is not None:
+            newAD.append(audioData.view(run))
+        run = frames
+        if frames is None:
+            newAD.append(audioData.view(s))
+    if run is not None:
+        newAD.append(audioData.view(run))
     # audioData.unload()
     return newAD
 
 
+def _frames(audioData, index):
+    "Help `getpieces`: the frames that `index` takes, as a slice, if they are a plain forward run."
+    index = audioData._index(index)
+    if not isinstance(index, slice) or index.step not in (None, 1):
+        return None
+    if isinstance(index.start, float):
+        index = slice(int(index.start * audioData.sampleRate), int(index.stop * audioData.sampleRate))
+    if not (isinstance(index.start, (int, long)) and isinstance(index.stop, (int, long))):
+        return None
+    if index.start < 0 or index.stop < index.start:
+        return None
+    return index
+
+
 def assemble(audioDataList, numChannels=1, sampleRate=44100, verbose=True):
     """
     Collects audio samples for output.
@@ -773,7 +1317,7 @@ def assemble(audioDataList, numChannels=1, sampleRate=44100, verbose=True):
     """
     return AudioData(ndarray=numpy.concatenate([a.data for a in audioDataList]),
                         numChannels=numChannels,
-                        sampleRate=sampleRate, defer=False, verbose=verbose)
+                        sampleRate=sampleRate, defer=False, verbose=verbose, copy=False)
 
 
 def mix(dataA, dataB, mix=0.5):
@@ -864,14 +1408,14 @@ def megamix(dataList):
         if not isinstance(adata, AudioData):
             raise TypeError('input must be a list of AudioData objects')
         if len(adata) > len(newdata):
-            newseg = AudioData(ndarray=adata[:newdata.endindex].data,
+            newseg = AudioData(ndarray=adata.data[:newdata.endindex],
                                 numChannels=newdata.numChannels,
-                                sampleRate=newdata.sampleRate, defer=False)
+                                sampleRate=newdata.sampleRate, defer=False, copy=False)
             newseg.endindex = newdata.endindex
         else:
             newseg = AudioData(ndarray=adata.data,
                                 numChannels=newdata.numChannels,
-                                sampleRate=newdata.sampleRate, defer=False)
+                                sampleRate=newdata.sampleRate, defer=False, copy=False)
             newseg.endindex = adata.endindex
         newdata.data[:newseg.endindex] += (newseg.data / float(len(dataList))).astype(newdata.data.dtype)
     newdata.endindex = len(newdata)
@@ -887,45 +1431,68 @@ class LocalAudioFile(AudioData):
     Analyze API, then it does not bother uploading the file.
     """
 
-    def __init__(self, filename, verbose=True, defer=False, sampleRate=None, numChannels=None):
+    def __init__(self, filename, verbose=True, defer=False, sampleRate=None, numChannels=None, stream=False, memmap=False, windowed=False):
         """
         :param filename: path to a local MP3 file
+        :param stream: decode through a pipe rather than a temporary
+            wave file; see `AudioData`
+        :param memmap: if the track is already in the local db, map its
+            cached wave file read-only instead of loading it into memory
+        :param windowed: only ever decode the windows of the track that
+            are sliced; see `AudioData`
         """
 
         # Make sure we have a local database
         check_and_create_local_db()
-        track_md5 = hashlib.md5(file(filename, 'rb').read()).hexdigest()
-        if check_db(track_md5):
+        track_md5 = file_md5(filename)
+        self._original = (filename, track_md5)
+        cached = check_db(track_md5)
+        if cached:
             log.info("Loading audio from local db")
             filename = get_audio_file(track_md5)
             numChannels = 2
             sampleRate = 44100
-        AudioData.__init__(self, filename=filename, verbose=verbose, defer=defer,
-                            sampleRate=sampleRate, numChannels=numChannels)
-
-        if verbose:
-            log.info("Computed MD5 of file is %s", track_md5)
+        # Decode the audio while the analysis is fetched; neither needs
+        # the other.
+        decoder = ExceptionThread(target=AudioData.__init__, args=(self,),
+                                  kwargs=dict(filename=filename, verbose=verbose, defer=defer,
+                                              sampleRate=sampleRate, numChannels=numChannels,
+                                              stream=stream, memmap=memmap, windowed=windowed))
+        decoder.start()
+        try:
+            if verbose:
+                log.info("Computed MD5 of file is %s", track_md5)
 
-        if check_db(track_md5):
-            log.info("Loading analysis from local db")
-            track_file = get_analysis_file(track_md5)
-            tempanalysis = AudioAnalysis(track_file, fromLocal=True)
-        else:
-            try:
-                if verbose:
-                    log.info("Probing for existing analysis")
-                tempanalysis = AudioAnalysis(track_md5)
-            except Exception:
-                if verbose:
-                    log.info("Analysis not found. Uploading...")
-                tempanalysis = AudioAnalysis(filename)
+            if cached:
+                log.info("Loading analysis from local db")
+                track_file = get_analysis_file(track_md5)
+                tempanalysis = AudioAnalysis(track_file, fromLocal=True)
+            else:
+                try:
+                    if verbose:
+                        log.info("Probing for existing analysis")
+                    tempanalysis = AudioAnalysis(track_md5)
+                except Exception:
+                    if verbose:
+                        log.info("Analysis not found. Uploading...")
+                    tempanalysis = AudioAnalysis(filename)
+        finally:
+            decoder.join()
 
         self.analysis = tempanalysis
         self.analysis.source = self
 
-        if not check_db(track_md5):
-            log.info("Saving track to local db")
-            save_to_local(track_md5, self.convertedfile, self.analysis.pyechonest_track)
+        if not cached:
+            audio_file = self.convertedfile
+            move = False
+            if audio_file is None and isinstance(self.data, numpy.ndarray):
+                # Streamed decodes never touch the disk, so write the cached
+                # copy straight from memory.
+                audio_file = self.encode(temp_audio_file(track_md5), mp3=False)
+                move = True
+            if audio_file is not None:
+                log.info("Saving track to local db")
+                save_to_local(track_md5, audio_file, self.analysis, move=move)
 
 
     def toxml(self, context=None):
@@ -939,6 +1506,15 @@ class LocalAudioFile(AudioData):
         """
         return self.analysis.duration
 
+    def info(self):
+        """
+        Returns the `MediaInfo` of the file the track was loaded from
+        (rather than of its copy in the local db); see `AudioData`.
+        """
+        if getattr(self, '_info', None) is None:
+            self._info = file_info(*self._original)
+        return self._info
+
     def __setstate__(self, state):
         """
         Recreates circular reference after unpickling.
@@ -958,7 +1534,8 @@ class LocalAnalysis(object):
         :param filename: path to a local MP3 file
         """
 
-        track_md5 = hashlib.md5(file(filename, 'rb').read()).hexdigest()
+        check_and_create_local_db()
+        track_md5 = file_md5(filename)
         if verbose:
             log.info("Computed MD5 of file is %s", track_md5)
         try:
@@ -972,6 +1549,69 @@ class LocalAnalysis(object):
         self.analysis = tempanalysis
         self.analysis.source = self
 
+
+def load_many(filenames, workers=4, **kwargs):
+    """
+    Loads a `LocalAudioFile` for each of `filenames` on a pool of `workers`
+    threads, which overlaps their decoding, hashing and analysis
+    (ffmpeg runs in its own process, and numpy releases the GIL).
+    Returns the `LocalAudioFile`\s in the order of `filenames`. If any
+    fail to load, raises a `LoadError` once the others are done.
+
+    :param filenames: paths to local audio files
+    :param workers: number of files to load at once
+    :param kwargs: passed on to each `LocalAudioFile`
+    """
+    def load(filename):
+        try:
+            return LocalAudioFile(filename, **kwargs), None
+        except Exception as e:
+            log.warning("Could not load %s:\n%s", filename, traceback.format_exc())
+            return None, e
+
+    pool = ThreadPool(max(1, min(workers, len(filenames))))
+    try:
+        outcomes = pool.map(load, filenames)
+    finally:
+        pool.close()
+        pool.join()
+    results = [result for result, error in outcomes]
+    errors = [error for result, error in outcomes]
+    failed = len(errors) - errors.count(None)
+    if failed:
+        raise LoadError("%d of %d files could not be loaded" % (failed, len(filenames)),
+                        results, errors)
+    return results
+
+
+class _Column(object):
+    """
+    Reads an attribute of an `AudioQuantum` from the corresponding column
+    of its `AnalysisTable`, unless the attribute was set on the quantum
+    itself. Missing values give `default` or, without one, AttributeError.
+    """
+    _missing = object()
+
+    def __init__(self, name, default=_missing):
+        self.name = name
+        self.default = default
+
+    def __get__(self, aq, owner):
+        if aq is None:
+            return self
+        table = aq._table
+        value = None
+        if table is not None and self.name in table.columns:
+            value = table.columns[self.name][aq._row]
+            if hasattr(value, 'tolist'):
+                value = value.tolist()
+        if value is None or value != value:
+            if self.default is self._missing:
+                raise AttributeError(self.name)
+            return self.default
+        return value
+
+
 class AudioQuantum(AudioRenderable):
     """
     A unit of musical time, identified at minimum with a start time and
@@ -988,6 +1628,25 @@ class AudioQuantum(AudioRenderable):
         created upon creation of the `AudioQuantumList` that covers
         the whole track
     """
+    _source = None
+    # Set on quanta created by an `AnalysisTable`, which reads their
+    # remaining attributes from its columns.
+    _table = None
+    _row = None
+    # Position in `container`, recorded by `AudioQuantumList.attach`.
+    _position = None
+
+    # These are only for sections, for now.
+    key = _Column('key', None)
+    key_confidence = _Column('key_confidence', None)
+    mode = _Column('mode', None)
+    mode_confidence = _Column('mode_confidence', None)
+    tempo = _Column('tempo', None)
+    tempo_confidence = _Column('tempo_confidence', None)
+    loudness = _Column('loudness', None)
+    time_signature = _Column('time_signature', None)
+    time_signature_confidence = _Column('time_signature_confidence', None)
+
     def __init__(self, start=0, duration=0, kind=None, confidence=None, source=None,
                 key=None, key_confidence=None, mode=None, mode_confidence=None,
                 tempo=None, tempo_confidence=None, loudness=None,
@@ -1039,6 +1698,7 @@ class AudioQuantum(AudioRenderable):
     def set_source(self, value):
         if isinstance(value, AudioData):
             self._source = value
+            AudioQuantumList._source_generation += 1
         else:
             raise TypeError("Source must be an instance of echonest.remix.audio.AudioData")
 
@@ -1058,6 +1718,9 @@ class AudioQuantum(AudioRenderable):
                        'bar':   'sections'}
         try:
             all_chunks = getattr(self.container.container, parent_dict[self.kind])
+            found = all_chunks.interval_index().overlapping(self.start, self.end)
+            if found is not None:
+                return found[0] if found else None
             for chunk in all_chunks:
                 if self.start < chunk.end and self.end > chunk.start:
                     return chunk
@@ -1077,6 +1740,9 @@ class AudioQuantum(AudioRenderable):
                          'section': 'bars'}
         try:
             all_chunks = getattr(self.container.container, children_dict[self.kind])
+            found = all_chunks.interval_index().within(self.start, self.end)
+            if found is not None:
+                return AudioQuantumList(found, kind=children_dict[self.kind])
             child_chunks = AudioQuantumList(kind=children_dict[self.kind])
             for chunk in all_chunks:
                 if chunk.start >= self.start and chunk.end <= self.end: 
@@ -1098,6 +1764,9 @@ class AudioQuantum(AudioRenderable):
             return [self]
 
         all_segments = self.source.analysis.segments
+        found = all_segments.interval_index().overlapping(self.start, self.end)
+        if found is not None:
+            return AudioQuantumList(found, kind="segment")
         filtered_segments = AudioQuantumList(kind="segment")
         
         # Filter and then break once we've got the needed segments
@@ -1116,11 +1785,13 @@ class AudioQuantum(AudioRenderable):
         """
         temp_pitches = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         segments = self.segments
+        if not segments:
+            return None
         for segment in segments:
             for index, pitch in enumerate(segment.pitches):
                 temp_pitches[index] = temp_pitches[index] + pitch
-            mean_pitches = [pitch / len(segments) for pitch in temp_pitches]
-            return mean_pitches
+        mean_pitches = [pitch / len(segments) for pitch in temp_pitches]
+        return mean_pitches
     
     def mean_timbre(self):
         """
@@ -1130,11 +1801,13 @@ class AudioQuantum(AudioRenderable):
         """
         temp_timbre = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         segments = self.segments
+        if not segments:
+            return None
         for segment in segments:
             for index, timbre in enumerate(segment.timbre):
                 temp_timbre[index] = temp_timbre[index] + timbre
-            mean_timbre = [timbre / len(segments) for timbre in temp_timbre]
-            return mean_timbre
+        mean_timbre = [timbre / len(segments) for timbre in temp_timbre]
+        return mean_timbre
 
 
     def mean_loudness(self):
@@ -1159,14 +1832,26 @@ class AudioQuantum(AudioRenderable):
         else:
             return self.container
 
+    def _locate(self):
+        """
+        Help the navigation methods find the position of this quantum in
+        its container: the one recorded by `attach`, if it still holds.
+        """
+        group = self.container
+        pos = self._position
+        if pos is None or pos >= len(group) or group[pos] is not self:
+            pos = group.index(self)
+            self._position = pos
+        return pos
+
     def prev(self, step=1):
         """
         Step backwards in the containing `AudioQuantumList`.
         Returns `self` if a boundary is reached.
         """
-        group = self.container
         try:
-            loc = group.index(self)
+            group = self.container
+            loc = self._locate()
             new = max(loc - step, 0)
             return group[new]
         except Exception:
@@ -1177,9 +1862,9 @@ class AudioQuantum(AudioRenderable):
         Step forward in the containing `AudioQuantumList`.
         Returns `self` if a boundary is reached.
         """
-        group = self.container
         try:
-            loc = group.index(self)
+            group = self.container
+            loc = self._locate()
             new = min(loc + step, len(group))
             return group[new]
         except Exception:
@@ -1212,6 +1897,21 @@ class AudioQuantum(AudioRenderable):
         *index* is the (zero-indexed) position within its `group`\(), and
         *length* is the number of siblings within its `group`\().
         """
+        parent = self.parent()
+        if parent:
+            # The siblings are the members of our own container that lie
+            # within the parent, so they are a run of it around us.
+            try:
+                children_kind = {'beat': 'tatums', 'bar': 'beats', 'section': 'bars'}[parent.kind]
+                children_list = getattr(parent.container.container, children_kind)
+                bounds = self.container.interval_index().within_bounds(parent.start, parent.end)
+                if children_list is self.container and bounds is not None:
+                    lo, hi = bounds
+                    loc = self._locate()
+                    if lo <= loc < hi:
+                        return (loc - lo, hi - lo,)
+            except (AttributeError, LookupError, ValueError):
+                pass
         group = self.group()
         count = len(group)
         try:
@@ -1229,7 +1929,7 @@ class AudioQuantum(AudioRenderable):
         """
         group = self.container
         count = len(group)
-        loc = group.index(self)
+        loc = self._locate()
         return (loc, count,)
 
     def context_string(self):
@@ -1239,13 +1939,14 @@ class AudioQuantum(AudioRenderable):
 
             "bar 4 of 142, beat 3 of 4, tatum 2 of 3"
         """
-        if self.parent() and self.kind != "bar":
-            return "%s, %s %i of %i" % (self.parent().context_string(),
-                                  self.kind, self.local_context()[0] + 1,
-                                  self.local_context()[1])
+        parent = self.parent()
+        if parent and self.kind != "bar":
+            loc, count = self.local_context()
+            return "%s, %s %i of %i" % (parent.context_string(),
+                                  self.kind, loc + 1, count)
         else:
-            return "%s %i of %i" % (self.kind, self.absolute_context()[0] + 1,
-                                  self.absolute_context()[1])
+            loc, count = self.absolute_context()
+            return "%s %i of %i" % (self.kind, loc + 1, count)
 
     def __getstate__(self):
         """
@@ -1276,15 +1977,25 @@ class AudioQuantum(AudioRenderable):
             return source[self]
         if with_source != self.source:
             return
-        to_audio.add_at(start, with_source[self])
+        to_audio.add_at(start, with_source.view(self))
         return
 
+    def _compile(self, plan, start):
+        plan.add(self.source, self, start)
+
 
 class AudioSegment(AudioQuantum):
     """
     Subclass of `AudioQuantum` for the data-rich segments returned by
     the Analyze API.
     """
+    pitches = _Column('pitches')
+    timbre = _Column('timbre')
+    loudness_begin = _Column('loudness_begin')
+    loudness_max = _Column('loudness_max')
+    time_loudness_max = _Column('time_loudness_max')
+    loudness_end = _Column('loudness_end')
+
     def __init__(self, start=0., duration=0., pitches = None, timbre = None,
                  loudness_begin=0., loudness_max=0., time_loudness_max=0.,
                  loudness_end=None, kind='segment', source=None):
@@ -1327,6 +2038,10 @@ class AudioSegment(AudioQuantum):
         If this is the case, None will be returned.
         """
         all_tatums = self.source.analysis.tatums
+        # Only overlapping tatums can match below, so look at just those.
+        candidates = all_tatums.interval_index().overlapping(self.start, self.end)
+        if candidates is not None:
+            all_tatums = candidates
         filtered_tatums = []
         for tatum in all_tatums:
             # If the segment contains the tatum
@@ -1386,22 +2101,42 @@ class ModifiedRenderable(AudioRenderable):
     def sources(self):
         return self._original.sources
 
+    def _base(self, with_source):
+        "Help `render`: the original's samples, as a view where possible"
+        if isinstance(self._original, AudioQuantum):
+            return self._original.resolve_source(with_source).view(self._original)
+        return self._original.render(with_source=with_source)
+
     def render(self, start=0.0, to_audio=None, with_source=None):
         if not to_audio:
-            base = self._original.render(with_source=with_source)
-            copy = AudioData32(ndarray=base.data, sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
-            for effect in self._effects:
-                copy = effect.modify(copy)
-            return copy
+            return _apply_effects(self._base(with_source), self._effects)
         if with_source != self.source:
             return
-        base = self._original.render(with_source=with_source)
-        copy = AudioData32(ndarray=base.data, shape=base.data.shape, sampleRate=base.sampleRate, numChannels=base.numChannels, defer=False)
-        for effect in self._effects:
-            copy = effect.modify(copy)
+        frames = None
+        if isinstance(self._original, AudioQuantum):
+            frames = _frames(self.source, self._original)
+        if frames is not None:
+            copy = RENDER_CACHE.piece(self.source, frames.start, frames.stop - frames.start, self._effects)
+        else:
+            copy = _apply_effects(self._base(with_source), self._effects)
         to_audio.add_at(start, copy)
         return
 
+    def _compile(self, plan, start):
+        if isinstance(self._original, AudioQuantum):
+            # Gains alone go in the operation itself, where runs of them
+            # can be joined into one.
+            gain = 1.0
+            for effect in self._effects:
+                factor = _scalar_gain(effect)
+                if factor is None:
+                    plan.add(self.source, self._original, start, effects=tuple(self._effects))
+                    return
+                gain *= factor
+            plan.add(self.source, self._original, start, gain=gain)
+        else:
+            AudioRenderable._compile(self, plan, start)
+
     def toxml(self, context=None):
         outerattributedict = {'duration': str(self.duration)}
         node = etree.Element("modified_audioquantum", attrib=outerattributedict)
@@ -1437,6 +2172,7 @@ class LevelDB(AudioEffect):
         self.change = change
 
     def modify(self, adata):
+        adata.ensure_writable()
         adata.data *= pow(10., self.change / 20.)
         return adata
 
@@ -1446,6 +2182,7 @@ class AmplitudeFactor(AudioEffect):
         self.change = change
 
     def modify(self, adata):
+        adata.ensure_writable()
         adata.data *= self.change
         return adata
 
@@ -1480,6 +2217,318 @@ class TimeTruncateLength(AudioEffect):
         return adata[:endindex]
 
 
+def _scalar_gain(effect):
+    """
+    Help rendering: the factor that `effect` scales every sample by, if it
+    is a `LevelDB` or `AmplitudeFactor` with a single number for its
+    change, or None. Changes given per channel, as a tuple or an array,
+    are left to the effect's own `modify`.
+    """
+    kind = type(effect)
+    if kind not in (LevelDB, AmplitudeFactor) or not isinstance(effect.change, numbers.Real):
+        return None
+    if kind is LevelDB:
+        return pow(10., effect.change / 20.)
+    return float(effect.change)
+
+def _apply_effects(adata, effects):
+    """
+    Help rendering: a new `AudioData32` of `adata` passed through `effects`.
+    Leading `LevelDB`, `AmplitudeFactor`, `TimeTruncateFactor` and
+    `TimeTruncateLength` effects are fused, into a single factor and the
+    number of samples that survive the truncations, and applied in one
+    copy of the samples; any effects after those, from the first that is
+    not one of these or whose gain is not a single number, modify the copy
+    in turn. Several gains are rounded once rather than after each of them.
+    """
+    gain = 1.0
+    length = kept = len(adata.data)
+    fused = 0
+    for effect in effects:
+        kind = type(effect)
+        if kind in (LevelDB, AmplitudeFactor):
+            factor = _scalar_gain(effect)
+            if factor is None:
+                break
+            gain *= factor
+        elif kind in (TimeTruncateFactor, TimeTruncateLength):
+            if kind is TimeTruncateFactor:
+                end = int(effect.factor * length)
+                padded = effect.factor > 1
+            else:
+                end = int(effect.new_duration * adata.sampleRate)
+                padded = effect.new_duration > float(length) / adata.sampleRate
+            if padded:
+                length = max(length, end)
+            length = len(xrange(*slice(None, end).indices(length)))
+            kept = min(kept, length)
+        else:
+            break
+        fused += 1
+
+    data = numpy.zeros((length,) + adata.data.shape[1:], dtype=numpy.int32)
+    if gain == 1:
+        data[:kept] = adata.data[:kept]
+    else:
+        numpy.multiply(adata.data[:kept], gain, out=data[:kept], casting='unsafe')
+    copy = AudioData32(ndarray=data, sampleRate=adata.sampleRate,
+                       numChannels=adata.numChannels, defer=False, copy=False)
+    for effect in effects[fused:]:
+        copy = effect.modify(copy)
+    return copy
+
+
+_RenderOp = collections.namedtuple('_RenderOp', 'source start offset length gain effects')
+
+class RenderPlan(object):
+    """
+    A tree of `AudioQuantumList`\s, `Simultaneous`\es and
+    `ModifiedRenderable`\s of `AudioQuantum`\s, flattened into a list of
+    operations that each add `length` frames of `source`, from frame
+    `start`, to the output at frame `offset`, scaled by `gain` and then
+    passed through the `effects`. Running the plan adds every operation
+    straight into one output `AudioData`, without the slice and the
+    recursive `render` call per quantum that rendering the tree takes.
+
+    Anything else in the tree is kept in `nodes`, with its start time, and
+    rendered by its own `render` when the plan is run.
+    """
+    def __init__(self, sampleRate):
+        self.sampleRate = sampleRate
+        self.ops = []
+        self.nodes = []
+
+    @classmethod
+    def compile(cls, renderable, sampleRate, start=0.0):
+        """
+        Flattens `renderable`, placed `start` seconds into an output at
+        `sampleRate`, into a new `RenderPlan`.
+        """
+        plan = cls(sampleRate)
+        renderable._compile(plan, start)
+        return plan
+
+    def add(self, source, quantum, start, gain=1.0, effects=()):
+        """
+        Adds an operation for the samples of `quantum` in `source`, placed
+        at `start` seconds. If they carry straight on from the previous
+        operation, in both the source and the output, with the same gain
+        and no effects, that operation is lengthened instead. Only sources
+        at the output's sample rate are joined up this way: the frames of
+        others are not output frames, and they are resampled piece by piece.
+        """
+        index = source._index(quantum)
+        first = int(index.start * source.sampleRate)
+        last = int(index.stop * source.sampleRate)
+        offset = int(start * self.sampleRate)
+        if (self.ops and not effects and first >= 0 and last >= first
+                and source.sampleRate == self.sampleRate):
+            op = self.ops[-1]
+            if (op.source is source and not op.effects and op.gain == gain and
+                    op.start >= 0 and op.start + op.length == first and
+                    op.offset + op.length == offset):
+                self.ops[-1] = op._replace(length=op.length + last - first)
+                return
+        self.ops.append(_RenderOp(source, first, offset, last - first, gain, effects))
+
+    def execute(self, to_audio, sources):
+        """
+        Adds the plan into `to_audio`, one of `sources` at a time, the way
+        `AudioQuantumList.render` does: operations on other sources are
+        skipped, and deferred sources are unloaded once they are done with.
+        Operations and `nodes` are sorted by source in one pass, and each
+        node is only rendered with the sources it reports.
+        """
+        by_source = {}
+        for op in self.ops:
+            by_source.setdefault(op.source, []).append(op)
+        nodes = {}
+        for node, start in self.nodes:
+            for source in node.sources():
+                nodes.setdefault(source, []).append((node, start))
+        for source in sources:
+            self._add(to_audio, source, by_source.get(source, ()))
+            for node, start in nodes.get(source, ()):
+                node.render(start=start, to_audio=to_audio, with_source=source)
+            if source.defer:
+                source.unload()
+        return to_audio
+
+    def _add(self, to_audio, source, ops):
+        "Help `execute`: add all the operations on `source` into `to_audio`."
+        if not ops:
+            return
+        if not isinstance(source.data, numpy.ndarray) and source.defer and not source.windowed:
+            source.load()
+        direct = (isinstance(source.data, numpy.ndarray)
+                  and source.encoded_channels() == to_audio.encoded_channels()
+                  and (not source.sampleRate or not to_audio.sampleRate
+                       or source.sampleRate == to_audio.sampleRate))
+        # Pad once for the plain operations, whose lengths are known up front,
+        # then add each piece as soon as it is made, so that only one is
+        # held at a time.
+        if direct:
+            frames = len(source.data)
+            end = 0
+            for op in ops:
+                if not op.effects:
+                    end = max(end, op.offset + len(xrange(*slice(op.start, op.start + op.length).indices(frames))))
+            to_audio.pad_with_zeros(end - len(to_audio.data))
+        to_audio.ensure_writable()
+        low, high = None, 0
+        for op in ops:
+            if op.effects:
+                piece = RENDER_CACHE.piece(source, op.start, op.length, op.effects)
+                samples = to_audio._conform(piece).data
+            elif direct and op.gain == 1.0:
+                samples = source.data[op.start:op.start + op.length]
+            else:
+                piece = source.getslice(slice(op.start, op.start + op.length), copy=False)
+                if op.gain != 1.0:
+                    piece = _apply_effects(piece, (AmplitudeFactor(op.gain),))
+                samples = to_audio._conform(piece).data
+            stop = op.offset + len(samples)
+            if stop > len(to_audio.data):
+                to_audio.pad_with_zeros(stop - len(to_audio.data))
+            to_audio.data[op.offset:stop] += samples
+            low = op.offset if low is None else min(low, op.offset)
+            high = max(high, stop)
+        if low is not None:
+            to_audio._update_peak(low, high)
+
+
+class RenderCache(object):
+    """
+    Keeps the samples of recently rendered pieces (a stretch of a source,
+    passed through a chain of effects) up to `budget` bytes, dropping the
+    least recently used first, so that a piece rendered over and over is
+    only rendered once.
+
+    Pieces are found by their source, its samples array, frames and the
+    class and settings of each effect, so equal effects made separately
+    share pieces, and a source given new samples (``source.data = ...``)
+    gets new pieces. Entries hold their source and its samples weakly, and
+    are only used for those same objects.
+
+    Samples changed in place (``source.data[...] = ...``) can't be seen
+    here: call `clear` after doing so, or the old pieces are reused.
+    """
+    def __init__(self, budget=RENDER_CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self._pieces = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def piece(self, source, start, length, effects):
+        """
+        Returns an `AudioData32` of `length` frames of `source` from frame
+        `start`, passed through `effects`. Its samples are read-only, and
+        may be shared with other callers.
+        """
+        data = source.data
+        try:
+            key = (id(source), id(data), start, length,
+                   tuple((type(effect), tuple(sorted(effect.__dict__.items()))) for effect in effects))
+            hash(key)
+        except TypeError:  # effects with settings that can't be compared
+            key = None
+        if key is not None:
+            with self._lock:
+                entry = self._pieces.pop(key, None)
+                if entry is not None:
+                    ref, data_ref, piece = entry
+                    if ref() is source and (data_ref is None or data_ref() is data):
+                        self._pieces[key] = entry
+                        return piece
+                    self.size -= piece.data.nbytes
+
+        piece = _apply_effects(source.getslice(slice(start, start + length), copy=False), effects)
+        piece.data.flags.writeable = False
+        if key is None or (self.budget is not None and piece.data.nbytes > self.budget):
+            return piece
+        with self._lock:
+            old = self._pieces.pop(key, None)
+            if old is not None:
+                self.size -= old[-1].data.nbytes
+            self._pieces[key] = (weakref.ref(source),
+                                 None if data is None else weakref.ref(data), piece)
+            self.size += piece.data.nbytes
+            while self.budget is not None and self.size > self.budget:
+                dropped = self._pieces.popitem(last=False)[1][-1]
+                self.size -= dropped.data.nbytes
+        return piece
+
+    def clear(self):
+        "Drops every piece."
+        with self._lock:
+            self._pieces.clear()
+            self.size = 0
+
+# Rendered pieces shared by all renders. Replace it to change its budget, and
+# clear it after changing a source's samples in place.
+RENDER_CACHE = RenderCache()
+
+
+class _IntervalIndex(object):
+    """
+    The start and end times of the quanta in an `AudioQuantumList`, for
+    answering overlap and containment queries by bisection. Queries
+    return None when the starts or ends are not in ascending order, in
+    which case the caller has to scan the list itself.
+    """
+    def __init__(self, quanta):
+        self.quanta = list(quanta)
+        try:
+            self.starts = [q.start for q in self.quanta]
+            self.ends = [q.end for q in self.quanta]
+        except AttributeError:
+            # Not every member is an AudioQuantum.
+            self.monotone = False
+            return
+        self.monotone = (all(a <= b for a, b in zip(self.starts, self.starts[1:])) and
+                         all(a <= b for a, b in zip(self.ends, self.ends[1:])))
+
+    def overlapping(self, start, end):
+        """
+        Returns the quanta that start before `end` and end after `start`,
+        in list order.
+        """
+        if not self.monotone:
+            return None
+        lo = bisect.bisect_right(self.ends, start)
+        hi = bisect.bisect_left(self.starts, end, lo)
+        return self.quanta[lo:hi]
+
+    def within(self, start, end):
+        """
+        Returns the quanta that start at or after `start` and end at or
+        before `end`, in list order.
+        """
+        bounds = self.within_bounds(start, end)
+        if bounds is None:
+            return None
+        return self.quanta[bounds[0]:bounds[1]]
+
+    def within_bounds(self, start, end):
+        "Like `within`, but returns the (*lo*, *hi*) positions of the run."
+        if not self.monotone:
+            return None
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_right(self.ends, end, lo)
+        return (lo, hi)
+
+
+def _invalidating(method):
+    "Help `AudioQuantumList`: wraps a list method so that it drops the list's index and sources."
+    def fun(self, *args, **kwargs):
+        self._interval_index = None
+        self._version += 1
+        return method(self, *args, **kwargs)
+    fun.__name__ = method.__name__
+    fun.__doc__ = method.__doc__
+    return fun
+
+
 class AudioQuantumList(list, AudioRenderable):
     """
     A container that enables content-based selection and filtering.
@@ -1498,7 +2547,24 @@ class AudioQuantumList(list, AudioRenderable):
     If `AudioQuantumList.kind` is "`segment`", then `pitches`, `timbre`,
     `loudness_begin`, `loudness_max`, `time_loudness_max`, and `loudness_end`
     are available.
+
+    The list keeps a sorted index of the start and end times of its
+    members, which `AudioQuantum.parent`\(), `children`\(), `segments`
+    and `AudioSegment.tatum` use, and the set of its `sources`\().
+    Modifying the list through its methods drops these, and the sources
+    of the lists that contain it; setting the `source` of a list, quantum
+    or analysis drops the sources of every list. After changing the
+    `start`, `duration` or `container` of a member in place, call
+    `reindex`\().
     """
+    _interval_index = None
+    _sources = None
+    # Bumped by each change to the list's own members.
+    _version = 0
+    # Bumped by every change to a source that quanta can take theirs from,
+    # which may be shared by any number of lists.
+    _source_generation = 0
+
     def __init__(self, initial = None, kind = None, container = None, source = None):
         """
         Initializes an `AudioQuantumList`. All parameters are optional.
@@ -1545,6 +2611,35 @@ class AudioQuantumList(list, AudioRenderable):
                 raise AttributeError("<%s> only accessible for segments" % (attribute,))
         return fun
 
+    append = _invalidating(list.append)
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    remove = _invalidating(list.remove)
+    pop = _invalidating(list.pop)
+    sort = _invalidating(list.sort)
+    reverse = _invalidating(list.reverse)
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    __setslice__ = _invalidating(list.__setslice__)
+    __delslice__ = _invalidating(list.__delslice__)
+    __iadd__ = _invalidating(list.__iadd__)
+    __imul__ = _invalidating(list.__imul__)
+
+    def interval_index(self):
+        """
+        Returns the index of the start and end times of the contained
+        `AudioQuantum`\s, building it if the list has changed since.
+        """
+        if self._interval_index is None:
+            self._interval_index = _IntervalIndex(list.__iter__(self))
+        return self._interval_index
+
+    def reindex(self):
+        "Rebuilds the index of start and end times, and the set of sources."
+        self._interval_index = None
+        AudioQuantumList._source_generation += 1
+        return self.interval_index()
+
     def get_duration(self):
         return sum(self.durations)
 
@@ -1565,6 +2660,7 @@ class AudioQuantumList(list, AudioRenderable):
         "Checks input to see if it is an `AudioData`."
         if isinstance(value, AudioData):
             self._source = value
+            AudioQuantumList._source_generation += 1
         else:
             raise TypeError("Source must be an instance of echonest.remix.audio.AudioData")
 
@@ -1588,11 +2684,111 @@ class AudioQuantumList(list, AudioRenderable):
     Total duration of the `AudioQuantumList`.
     """)
 
+    def mean_pitches_matrix(self, weighted=True):
+        """
+        Returns an N x 12 `numpy.array` with, for each `AudioQuantum`, the
+        mean of the pitch vectors of the segments that overlap it, weighted
+        by how long each overlaps it. With `weighted` False, this is the
+        plain mean that `AudioQuantum.mean_pitches`\() returns.
+        """
+        return self._segment_means('pitches', weighted)
+
+    def mean_timbre_matrix(self, weighted=True):
+        """
+        Returns an N x 12 `numpy.array` with, for each `AudioQuantum`, the
+        mean of the timbre vectors of the segments that overlap it, weighted
+        by how long each overlaps it. With `weighted` False, this is the
+        plain mean that `AudioQuantum.mean_timbre`\() returns.
+        """
+        return self._segment_means('timbre', weighted)
+
+    def mean_loudness_vector(self, weighted=True):
+        """
+        Returns a `numpy.array` with, for each `AudioQuantum`, the mean of
+        the maximum loudness of the segments that overlap it, weighted by
+        how long each overlaps it. With `weighted` False, this is the plain
+        mean that `AudioQuantum.mean_loudness`\() returns.
+        """
+        return self._segment_means('loudness_max', weighted)
+
+    def _segment_means(self, column, weighted):
+        """
+        Help the mean_* methods: averages a column of the segments table
+        over every quantum at once. Quanta that overlap no segments get
+        zeros; segments get their own values.
+        """
+        quanta = list(list.__iter__(self))
+        width = (12,) if column in ('pitches', 'timbre') else ()
+        out = numpy.zeros((len(quanta),) + width)
+        by_analysis = collections.OrderedDict()
+        for row, aq in enumerate(quanta):
+            if aq.kind == 'segment':
+                out[row] = getattr(aq, column)
+            else:
+                analysis = aq.source.analysis
+                by_analysis.setdefault(id(analysis), (analysis, []))[1].append(row)
+
+        for analysis, rows in by_analysis.values():
+            table = analysis.table('segment')
+            seg_starts = table.start
+            seg_ends = table.start + table.duration
+            starts = numpy.array([quanta[r].start for r in rows], dtype=numpy.float64)
+            ends = starts + numpy.array([quanta[r].duration for r in rows], dtype=numpy.float64)
+
+            # Each quantum overlaps a run lo:hi of the segments; list every
+            # (quantum, segment) pair of those runs.
+            lo = numpy.searchsorted(seg_ends, starts, 'right')
+            hi = numpy.maximum(numpy.searchsorted(seg_starts, ends, 'left'), lo)
+            counts = hi - lo
+            owner = numpy.repeat(numpy.arange(len(rows)), counts)
+            segs = (numpy.arange(counts.sum()) + numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts))
+
+            if weighted:
+                weights = (numpy.minimum(seg_ends[segs], ends[owner]) -
+                           numpy.maximum(seg_starts[segs], starts[owner]))
+                # Quanta of no duration take the plain mean.
+                totals = numpy.bincount(owner, weights, minlength=len(rows))
+                weights[totals[owner] <= 0] = 1.
+            else:
+                weights = numpy.ones(len(segs))
+            totals = numpy.bincount(owner, weights, minlength=len(rows))
+            totals[totals == 0] = 1.
+
+            values = table.columns[column][segs]
+            if values.ndim == 1:
+                sums = numpy.bincount(owner, values * weights, minlength=len(rows))
+                out[rows] = sums / totals
+            else:
+                sums = numpy.column_stack([numpy.bincount(owner, values[:, i] * weights, minlength=len(rows))
+                                           for i in xrange(values.shape[1])])
+                out[rows] = sums / totals[:, numpy.newaxis]
+        return out
+
     def sources(self):
-        ss = set()
-        for aq in list.__iter__(self):
-            ss.update(aq.sources())
-        return ss
+        """
+        Returns the set of `AudioData` sources of the contained quanta.
+        The set is kept until this list, a list inside it or a source is
+        changed.
+        """
+        if not self._sources_current():
+            key = (AudioQuantumList._source_generation, self._version)
+            ss = set()
+            inner = []
+            for aq in list.__iter__(self):
+                ss.update(aq.sources())
+                if isinstance(aq, ModifiedRenderable):
+                    aq = aq._original
+                if isinstance(aq, AudioQuantumList):
+                    inner.append((aq, aq._sources))
+            self._sources = (key, inner, ss)
+        return set(self._sources[2])
+
+    def _sources_current(self):
+        "Help `sources`: whether the kept set still holds."
+        cached = self._sources
+        if cached is None or cached[0] != (AudioQuantumList._source_generation, self._version):
+            return False
+        return all(aql._sources is kept and aql._sources_current() for aql, kept in cached[1])
 
     def attach(self, container):
         """
@@ -1600,8 +2796,10 @@ class AudioQuantumList(list, AudioRenderable):
         contained `AudioQuantum` objects.
         """
         self.container = container
-        for i in self:
+        for pos, i in enumerate(self):
             i.container = self
+            i._position = pos
+        self.reindex()
 
     def __getstate__(self):
         """
@@ -1610,6 +2808,8 @@ class AudioQuantumList(list, AudioRenderable):
         dictclone = self.__dict__.copy()
         if 'container' in dictclone:
             del dictclone['container']
+        dictclone.pop('_interval_index', None)
+        dictclone.pop('_sources', None)
         return dictclone
 
     def toxml(self, context=None):
@@ -1642,14 +2842,8 @@ class AudioQuantumList(list, AudioRenderable):
                 dur += int(aq.duration * tempsource.sampleRate)
             to_audio = self.init_audio_data(tempsource, dur)
         if not hasattr(with_source, 'data'):
-            for tsource in self.sources():
-                this_start = start
-                for aq in list.__iter__(self):
-                    aq.render(start=this_start, to_audio=to_audio, with_source=tsource)
-                    this_start += aq.duration
-                if tsource.defer:
-                    tsource.unload()
-            return to_audio
+            plan = RenderPlan.compile(self, to_audio.sampleRate, start)
+            return plan.execute(to_audio, self.sources())
         else:
             if with_source not in self.sources():
                 return
@@ -1657,6 +2851,11 @@ class AudioQuantumList(list, AudioRenderable):
                 aq.render(start=start, to_audio=to_audio, with_source=with_source)
                 start += aq.duration
 
+    def _compile(self, plan, start):
+        for aq in list.__iter__(self):
+            aq._compile(plan, start)
+            start += aq.duration
+
 
 class Simultaneous(AudioQuantumList):
     """
@@ -1705,12 +2904,8 @@ class Simultaneous(AudioQuantumList):
             dur = int(max(self.durations) * tempsource.sampleRate)
             to_audio = self.init_audio_data(tempsource, dur)
         if not hasattr(with_source, 'data'):
-            for source in self.sources():
-                for aq in list.__iter__(self):
-                    aq.render(start=start, to_audio=to_audio, with_source=source)
-                if source.defer:
-                    source.unload()
-            return to_audio
+            plan = RenderPlan.compile(self, to_audio.sampleRate, start)
+            return plan.execute(to_audio, self.sources())
         else:
             if with_source not in self.sources():
                 return
@@ -1718,45 +2913,163 @@ class Simultaneous(AudioQuantumList):
                 for aq in list.__iter__(self):
                     aq.render(start=start, to_audio=to_audio, with_source=with_source)
 
+    def _compile(self, plan, start):
+        for aq in list.__iter__(self):
+            aq._compile(plan, start)
+
+class AnalysisTable(object):
+    """
+    Holds every unit of one kind of an analysis ("bar", "beat", "tatum",
+    "section" or "segment") as a struct of `numpy.array`\s: `start`,
+    `duration` and `confidence` vectors plus, for segments, N x 12
+    `pitches` and `timbre` matrices and the loudness vectors, and for
+    sections their key, mode, tempo, time signature and loudness.
+
+    Columns are attributes of the table, e.g. `table.pitches`. The
+    `AudioQuantum` objects of the analysis are made from a table by
+    `quanta`\(), and read any column they do not hold themselves from it.
+    Missing values are NaN (or None, for the section columns).
+    """
+    SECTION_COLUMNS = ('key', 'key_confidence', 'mode', 'mode_confidence',
+                       'tempo', 'tempo_confidence', 'time_signature',
+                       'time_signature_confidence', 'loudness')
+
+    def __init__(self, kind, start, duration, confidence=None, **columns):
+        """
+        :param kind: the kind of the `AudioQuantum`\s in the table
+        :param start: sequence of start times, in seconds
+        :param duration: sequence of durations, in seconds
+        :param confidence: optional sequence of confidences
+        :param columns: any further named columns, one row per unit
+        """
+        self.kind = kind
+        self.columns = columns
+        columns['start'] = numpy.asarray(start, dtype=numpy.float64)
+        columns['duration'] = numpy.asarray(duration, dtype=numpy.float64)
+        if confidence is None:
+            confidence = numpy.empty(len(columns['start']))
+            confidence.fill(numpy.nan)
+        columns['confidence'] = numpy.asarray(confidence, dtype=numpy.float64)
+
+    @classmethod
+    def from_nodes(cls, kind, nodes):
+        """
+        Builds a table from the list of dictionaries that the Analyze API
+        returns for `kind`.
+        """
+        if kind == 'segment':
+            return cls._from_segments(nodes)
+        start = numpy.array([n['start'] for n in nodes], dtype=numpy.float64)
+        if kind == 'section':
+            duration = [n['duration'] for n in nodes]
+            # Make sure that we do not break due to an old analysis file
+            columns = {}
+            for name in cls.SECTION_COLUMNS:
+                columns[name] = numpy.array([n.get(name) for n in nodes], dtype=object)
+            return cls(kind, start, duration, **columns)
+        # Bars, beats and tatums last until the next one starts.
+        duration = numpy.zeros(len(start))
+        if len(start) > 1:
+            duration[:-1] = numpy.diff(start)
+            duration[-1] = duration[-2]
+        confidence = [n['confidence'] for n in nodes]
+        return cls(kind, start, duration, confidence)
+
+    @classmethod
+    def _from_segments(cls, nodes):
+        count = len(nodes)
+        pitches = numpy.zeros((count, 12))
+        timbre = numpy.zeros((count, 12))
+        for row, n in enumerate(nodes):
+            pitches[row] = n['pitches']
+            timbre[row] = n['timbre']
+        loudness_end = numpy.array([n.get('loudness_end') or numpy.nan for n in nodes],
+                                    dtype=numpy.float64)
+        return cls('segment',
+                   [n['start'] for n in nodes],
+                   [n['duration'] for n in nodes],
+                   pitches=pitches, timbre=timbre,
+                   loudness_begin=numpy.array([n['loudness_start'] for n in nodes], dtype=numpy.float64),
+                   loudness_max=numpy.array([n['loudness_max'] for n in nodes], dtype=numpy.float64),
+                   time_loudness_max=numpy.array([n['loudness_max_time'] for n in nodes], dtype=numpy.float64),
+                   loudness_end=loudness_end)
+
+    def to_arrays(self):
+        """
+        Returns the columns as a dictionary of numeric `numpy.array`\s, for
+        `AudioAnalysis.save`. Missing values become NaN.
+        """
+        arrays = {}
+        for name, column in self.columns.items():
+            if column.dtype == object:
+                column = numpy.array([numpy.nan if v is None else v for v in column],
+                                     dtype=numpy.float64)
+            arrays[name] = column
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, kind, arrays):
+        "The inverse of `to_arrays`."
+        columns = dict(arrays)
+        if kind == 'section':
+            for name in cls.SECTION_COLUMNS:
+                if name not in columns:
+                    continue
+                integral = name in ('key', 'mode', 'time_signature')
+                columns[name] = numpy.array([None if v != v else (int(v) if integral else v)
+                                             for v in columns[name].tolist()], dtype=object)
+        return cls(kind, **columns)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def quanta(self):
+        """
+        Returns an `AudioQuantumList` with an `AudioQuantum` (an
+        `AudioSegment`, for segments) for each row. The quanta hold only
+        their start, duration, confidence and kind, and read everything
+        else from this table.
+        """
+        if self.kind == 'segment':
+            kind = AudioSegment
+        else:
+            kind = AudioQuantum
+        new = object.__new__
+        items = []
+        rows = zip(self.start.tolist(), self.duration.tolist(), self.confidence.tolist())
+        for row, (start, duration, confidence) in enumerate(rows):
+            aq = new(kind)
+            aq.__dict__.update(start=start, duration=duration, kind=self.kind,
+                               confidence=confidence if confidence == confidence else None,
+                               _table=self, _row=row)
+            items.append(aq)
+        out = AudioQuantumList(kind=self.kind)
+        list.extend(out, items)
+        return out
+
+
 # Used for creating bars, beats, and tatums
 def _dataParser(tag, nodes):
-    out = AudioQuantumList(kind=tag)
-    for n in nodes:
-        out.append(AudioQuantum(start=n['start'], kind=tag, confidence=n['confidence']))
-    if len(out) > 1:
-        for i in range(len(out) - 1) :
-            out[i].duration = out[i + 1].start - out[i].start
-        out[-1].duration = out[-2].duration
-    return out
+    return AnalysisTable.from_nodes(tag, nodes).quanta()
 
 # Used for creating sections
 def _attributeParser(tag, nodes):
-    out = AudioQuantumList(kind=tag)
-    for n in nodes:
-        # Make sure that we do not break due to an old analysis file
-        try:
-            out.append(AudioQuantum(start=n['start'], duration=n['duration'], kind=tag, 
-                                    key=n['key'], key_confidence=n['key_confidence'], 
-                                    mode=n['mode'], mode_confidence=n['mode_confidence'], 
-                                    tempo=n['tempo'], tempo_confidence=n['tempo_confidence'], 
-                                    time_signature=n['time_signature'], 
-                                    time_signature_confidence=n['time_signature_confidence'],
-                                    loudness=n['loudness']))
-        except KeyError:
-              out.append(AudioQuantum(start=n['start'], duration=n['duration'], kind=tag)) 
-    return out
+    return AnalysisTable.from_nodes(tag, nodes).quanta()
 
 # Used for creating segments
 def _segmentsParser(nodes):
-    out = AudioQuantumList(kind='segment')
-    for n in nodes:
-        out.append(AudioSegment(start=n['start'], duration=n['duration'],
-                                pitches=n['pitches'], timbre=n['timbre'],
-                                loudness_begin=n['loudness_start'],
-                                loudness_max=n['loudness_max'],
-                                time_loudness_max=n['loudness_max_time'],
-                                loudness_end=n.get('loudness_end')))
-    return out
+    return AnalysisTable.from_nodes('segment', nodes).quanta()
+
+def _is_npz(filename):
+    "Tells a file written by `AudioAnalysis.save` from a legacy JSON one."
+    with open(filename, 'rb') as f:
+        return f.read(4) == 'PK\x03\x04'
 
 class FileTypeError(Exception):
     def __init__(self, filename, message):
@@ -1772,3 +3085,16 @@ class EchoNestRemixError(Exception):
     Error raised by the Remix API.
     """
     pass
+
+
+class LoadError(EchoNestRemixError):
+    """
+    Error raised by `load_many` when some files could not be loaded.
+    `results` holds the `LocalAudioFile` of each file in order, or None
+    where it failed; `errors` holds the exception for each file that
+    failed, or None where it loaded.
+    """
+    def __init__(self, message, results, errors):
+        EchoNestRemixError.__init__(self, message)
+        self.results = results
+        self.errors = errors
@@ -3,13 +3,38 @@
 """
 local_db.py
 
-Functions for saving analysis and wave files to local storage
+Functions for saving analysis and wave files to local storage.
+
+The tracks in the db are listed in an sqlite index (in WAL mode, so that
+many processes can read and write it at once). Files are written under
+temporary names and renamed into place before their track is indexed,
+so a track that is found in the index always has complete files.
+
+The index also remembers the md5 of each file that was hashed, and the
+settings (duration, sample rate, and so on) of each file that was
+probed, so that neither is worked out twice for the same file.
+
+Files are kept in subdirectories named after the first two characters of
+the track's md5. The index records the size and last use of each track:
+tracks unused for COMPRESS_AFTER seconds have their audio compressed to
+FLAC, and once the db holds more than BUDGET bytes, the least recently
+(or, with EVICTION = 'lfu', least frequently) used tracks are removed.
+Saving a track does a bounded amount of this tidying; call maintain()
+(from cron, say) to do all of it.
 """
 
 import os
 import json
+import errno
+import hashlib
 import shutil
 import logging
+import sqlite3
+import tempfile
+import threading
+import time
+
+from support.ffmpeg import ffmpeg, probe, MediaInfo
 
 LOG = logging.getLogger(__name__)
 HOME = os.path.expanduser("~")
@@ -17,58 +42,339 @@ REMIX_PATH = '.remix-db'
 REMIX_FOLDER = HOME + os.path.sep + REMIX_PATH
 AUDIO_FOLDER = REMIX_FOLDER + os.path.sep + 'audio'
 ANALYSIS_FOLDER = REMIX_FOLDER + os.path.sep + 'analysis'
+INDEX = REMIX_FOLDER + os.path.sep + 'index.sqlite'
+# The line-per-track text file that older versions used as the index.
 DATABASE = REMIX_FOLDER + os.path.sep + 'database.db'
 
+# Seconds to wait for another process to release the index.
+INDEX_TIMEOUT = 60
+
+# Most bytes of audio and analysis to keep, or None for no limit.
+BUDGET = 20 * 1024 ** 3
+# Which tracks to remove first once over BUDGET: 'lru' or 'lfu'.
+EVICTION = 'lru'
+# Seconds after its last use that a track's audio is compressed, or None
+# to never compress.
+COMPRESS_AFTER = 7 * 24 * 60 * 60
+# Most tracks that saving a track compresses, or None for no limit.
+COMPRESS_PER_SAVE = 1
+# Seconds after which a compression that never finished (its process
+# died, say) may be claimed again.
+CLAIM_TIMEOUT = 60 * 60
+
+# Bytes of a file read at a time when hashing it.
+HASH_CHUNK = 1024 * 1024
+
+COLUMNS = (('md5', 'TEXT PRIMARY KEY'), ('created', 'REAL'), ('size', 'INTEGER'),
+           ('last_access', 'REAL'), ('hits', 'INTEGER DEFAULT 0'),
+           ('compressed', 'INTEGER DEFAULT 0'), ('claimed', 'REAL'))
+
+_local = threading.local()
+
+def _makedirs(path):
+    '''Create a directory, unless it (or another process) already has.'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+def _replace(source, target):
+    '''Atomically move source over target.'''
+    try:
+        os.rename(source, target)
+    except OSError:
+        # Windows will not rename over an existing file.
+        if os.name != 'nt' or not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source, target)
+
+def _remove(path):
+    '''Remove a file, unless it (or another process) already has.'''
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _connect():
+    '''Return this thread's connection to the index.'''
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.pid != os.getpid():
+        _makedirs(REMIX_FOLDER)
+        connection = sqlite3.connect(INDEX, timeout=INDEX_TIMEOUT)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS tracks (%s)' %
+                           ', '.join(' '.join(column) for column in COLUMNS))
+        existing = [row[1] for row in connection.execute('PRAGMA table_info(tracks)')]
+        for name, kind in COLUMNS:
+            if name not in existing:
+                try:
+                    connection.execute('ALTER TABLE tracks ADD COLUMN %s %s' % (name, kind))
+                except sqlite3.OperationalError:
+                    # Another process added it first.
+                    pass
+        connection.execute('CREATE TABLE IF NOT EXISTS hashes '
+                           '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, md5 TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS probes (md5 TEXT PRIMARY KEY, info TEXT)')
+        _local.connection = connection
+        _local.pid = os.getpid()
+    return connection
+
+def _shard(folder, track_md5):
+    '''Get the subdirectory of folder that holds the files of a track.'''
+    return folder + os.path.sep + track_md5[:2]
+
+def _migrate():
+    '''Move the tracks listed in an old text index into the sqlite one.'''
+    try:
+        with open(DATABASE, 'r') as db_file:
+            md5s = [(line.strip(), time.time()) for line in db_file if line.strip()]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    LOG.info("Migrating %d tracks to the new local database index.", len(md5s))
+    with _connect() as connection:
+        connection.executemany("INSERT OR IGNORE INTO tracks (md5, created) VALUES (?, ?)", md5s)
+    try:
+        _replace(DATABASE, DATABASE + '.old')
+    except OSError:
+        # Another process got here first.
+        pass
+
 def check_and_create_local_db():
     '''If the local db does not exist, create it.'''
-    home_dir = os.listdir(HOME)
-    if REMIX_PATH in home_dir:
+    if os.path.isdir(REMIX_FOLDER) and os.path.exists(INDEX):
         LOG.info("Found local database.")
-        return
     else:
         LOG.info("Local database not found, creating...")
-
-        os.mkdir(REMIX_FOLDER)
-        os.mkdir(AUDIO_FOLDER)
-        os.mkdir(ANALYSIS_FOLDER)
-
-        db_file = open(DATABASE, 'wb')
-        db_file.close()
+        _makedirs(AUDIO_FOLDER)
+        _makedirs(ANALYSIS_FOLDER)
+        _connect()
         LOG.info("Local database created.")
+    _migrate()
 
 def check_db(track_md5):
-    '''Check the DB and see if the track is in it.'''
-    with open(DATABASE, 'r') as db_file:
-        for line in db_file:
-            if track_md5 == line.strip():
-                return True
-    return False
-
-def save_to_local(track_md5, audio_file, pyechonest_track):
-    '''Save a track to the db.'''
-    with open(DATABASE, 'a') as db_file:
-        db_file.write(track_md5 + '\n')
-
-    save_audio_to_local(track_md5, audio_file)
-    save_analysis_to_local(track_md5, pyechonest_track)
-
-def save_audio_to_local(track_md5, audio_file):
-    '''Copy the uncompressed audio file to the db.'''
-    target_file = AUDIO_FOLDER + os.path.sep + track_md5 + '.wav'
-    shutil.copyfile(audio_file, target_file)
-
-def save_analysis_to_local(track_md5, pyechonest_track):
-    '''Save the pyechonest track dict as json to the db.'''
-    target_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis'
-    with open(target_file, 'wb') as db_file:
-        json.dump(pyechonest_track.__dict__, db_file)
+    '''Check the DB and see if the track is in it. Counts as a use of the track.'''
+    with _connect() as connection:
+        cursor = connection.execute('UPDATE tracks SET last_access = ?, hits = COALESCE(hits, 0) + 1 '
+                                    'WHERE md5 = ?', (time.time(), track_md5))
+        return cursor.rowcount > 0
+
+def file_md5(filename):
+    '''Get the md5 of a file, reading it in chunks. The md5 is remembered
+    against the path, size and modification time of the file, so an
+    unchanged file is only ever hashed once.'''
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    connection = _connect()
+    row = connection.execute('SELECT md5 FROM hashes WHERE path = ? AND size = ? AND mtime = ?',
+                             (path, stat.st_size, stat.st_mtime)).fetchone()
+    if row is not None:
+        return str(row[0])
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), ''):
+            digest.update(chunk)
+    track_md5 = digest.hexdigest()
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                           (path, stat.st_size, stat.st_mtime, track_md5))
+    return track_md5
+
+def file_info(filename, track_md5=None):
+    '''Get the MediaInfo of a file. It is remembered against the md5 of the
+    file (track_md5, if that is already known), so the same audio is only
+    ever probed once.'''
+    if track_md5 is None:
+        track_md5 = file_md5(filename)
+    connection = _connect()
+    row = connection.execute('SELECT info FROM probes WHERE md5 = ?', (track_md5,)).fetchone()
+    if row is not None:
+        fields = dict((str(k), tuple(v) if isinstance(v, list) else v)
+                      for k, v in json.loads(row[0]).items())
+        return MediaInfo(**fields)
+    info = probe(filename)
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO probes VALUES (?, ?)',
+                           (track_md5, json.dumps(info._asdict())))
+    return info
+
+def temp_audio_file(track_md5, suffix='.wav'):
+    '''Get a fresh temporary audio file in the db, to save_to_local with move=True.'''
+    folder = _shard(AUDIO_FOLDER, track_md5)
+    _makedirs(folder)
+    handle, path = tempfile.mkstemp(prefix=track_md5 + '.', suffix='.tmp' + suffix, dir=folder)
+    os.close(handle)
+    return path
+
+def save_to_local(track_md5, audio_file, analysis, move=False):
+    '''Save a track to the db. With move, audio_file is moved rather than copied.'''
+    size = save_audio_to_local(track_md5, audio_file, move)
+    size += save_analysis_to_local(track_md5, analysis)
+    now = time.time()
+    with _connect() as connection:
+        connection.execute('INSERT OR REPLACE INTO tracks (md5, created, size, last_access, hits, compressed) '
+                           'VALUES (?, ?, ?, ?, 0, 0)', (track_md5, now, size, now))
+    try:
+        maintain(compress_limit=COMPRESS_PER_SAVE, keep=track_md5)
+    except Exception:
+        LOG.warning("Could not tidy the local database.", exc_info=True)
+
+def save_audio_to_local(track_md5, audio_file, move=False):
+    '''Copy the uncompressed audio file to the db, and return its size.'''
+    target_file = _shard(AUDIO_FOLDER, track_md5) + os.path.sep + track_md5 + '.wav'
+    if os.path.abspath(audio_file) != os.path.abspath(target_file):
+        if not (move and _move(audio_file, target_file)):
+            temp_file = temp_audio_file(track_md5)
+            try:
+                shutil.copyfile(audio_file, temp_file)
+                _replace(temp_file, target_file)
+            except:
+                os.remove(temp_file)
+                raise
+            if move:
+                os.remove(audio_file)
+    # Drop any older, compressed copy.
+    _remove(_shard(AUDIO_FOLDER, track_md5) + os.path.sep + track_md5 + '.flac')
+    return os.path.getsize(target_file)
+
+def _move(source, target):
+    '''Rename source over target, or return False if they are on different filesystems.'''
+    try:
+        _replace(source, target)
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return False
+
+def save_analysis_to_local(track_md5, analysis):
+    '''Save an AudioAnalysis to the db in its binary format, and return its size.'''
+    folder = _shard(ANALYSIS_FOLDER, track_md5)
+    _makedirs(folder)
+    target_file = folder + os.path.sep + track_md5 + '.analysis'
+    handle, temp_file = tempfile.mkstemp(prefix=track_md5 + '.', suffix='.tmp', dir=folder)
+    os.close(handle)
+    try:
+        analysis.save(temp_file)
+        _replace(temp_file, target_file)
+    except:
+        os.remove(temp_file)
+        raise
+    return os.path.getsize(target_file)
+
+def _audio_files(track_md5):
+    '''All the places an audio file of a track may be, in order of preference.'''
+    folder = _shard(AUDIO_FOLDER, track_md5)
+    return [folder + os.path.sep + track_md5 + '.wav',
+            folder + os.path.sep + track_md5 + '.flac',
+            AUDIO_FOLDER + os.path.sep + track_md5 + '.wav']
+
+def _analysis_files(track_md5):
+    '''All the places the analysis of a track may be, in order of preference.'''
+    return [_shard(ANALYSIS_FOLDER, track_md5) + os.path.sep + track_md5 + '.analysis',
+            ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis']
+
+def _existing(paths):
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return paths[0]
 
 def get_audio_file(track_md5):
-    '''Get an audio file from the db.'''
-    target_file = AUDIO_FOLDER + os.path.sep + track_md5 + '.wav'
-    return target_file
+    '''Get an audio file from the db: a wave file, or a FLAC one if it was compressed.'''
+    return _existing(_audio_files(track_md5))
 
 def get_analysis_file(track_md5):
     '''Get an analysis file from the db.'''
-    target_file = ANALYSIS_FOLDER + os.path.sep + track_md5 + '.analysis'
-    return target_file
+    return _existing(_analysis_files(track_md5))
+
+def _file_size(track_md5):
+    return sum(os.path.getsize(path) for path in _audio_files(track_md5) + _analysis_files(track_md5)
+               if os.path.exists(path))
+
+def _claimable():
+    '''SQL condition for tracks that may be claimed for compression, with
+    one parameter: the time before which claims have expired.'''
+    return ('(COALESCE(compressed, 0) = 0 OR '
+            '(compressed = 2 AND COALESCE(claimed, 0) < ?))')
+
+def compress(track_md5):
+    '''Replace the wave file of a track with a FLAC one.'''
+    now = time.time()
+    with _connect() as connection:
+        # Claim the track, so that only one process compresses it.
+        cursor = connection.execute('UPDATE tracks SET compressed = 2, claimed = ? '
+                                    'WHERE md5 = ? AND ' + _claimable(),
+                                    (now, track_md5, now - CLAIM_TIMEOUT))
+        if cursor.rowcount == 0:
+            return
+    wave_file = get_audio_file(track_md5)
+    flac_file = _shard(AUDIO_FOLDER, track_md5) + os.path.sep + track_md5 + '.flac'
+    temp_file = temp_audio_file(track_md5, '.flac')
+    try:
+        ffmpeg(wave_file, temp_file, verbose=False)
+        _replace(temp_file, flac_file)
+    except:
+        _remove(temp_file)
+        with _connect() as connection:
+            connection.execute('UPDATE tracks SET compressed = 0 WHERE md5 = ?', (track_md5,))
+        raise
+    for path in _audio_files(track_md5):
+        if path != flac_file:
+            _remove(path)
+    with _connect() as connection:
+        connection.execute('UPDATE tracks SET compressed = 1, size = ? WHERE md5 = ?',
+                           (_file_size(track_md5), track_md5))
+
+def evict(track_md5):
+    '''Remove a track from the db.'''
+    with _connect() as connection:
+        connection.execute('DELETE FROM tracks WHERE md5 = ?', (track_md5,))
+    for path in _audio_files(track_md5) + _analysis_files(track_md5):
+        _remove(path)
+
+def maintain(compress_limit=None, keep=None):
+    '''Compress the tracks that went unused for COMPRESS_AFTER seconds (at
+    most compress_limit of them, if given), then evict tracks other than
+    keep until the db is within BUDGET.'''
+    connection = _connect()
+    # Tracks from older versions of the db were saved without a size.
+    for (track_md5,) in connection.execute('SELECT md5 FROM tracks WHERE size IS NULL').fetchall():
+        with connection:
+            connection.execute('UPDATE tracks SET size = ? WHERE md5 = ?',
+                               (_file_size(track_md5), track_md5))
+
+    if COMPRESS_AFTER is not None:
+        now = time.time()
+        query = ('SELECT md5 FROM tracks WHERE ' + _claimable() +
+                 ' AND COALESCE(last_access, created, 0) < ? ORDER BY COALESCE(last_access, created, 0)')
+        arguments = (now - CLAIM_TIMEOUT, now - COMPRESS_AFTER)
+        if compress_limit is not None:
+            query += ' LIMIT ?'
+            arguments += (compress_limit,)
+        cold = connection.execute(query, arguments).fetchall()
+        for (track_md5,) in cold:
+            LOG.info("Compressing %s in the local database.", track_md5)
+            compress(track_md5)
+
+    if BUDGET is None:
+        return
+    (total,) = connection.execute('SELECT COALESCE(SUM(size), 0) FROM tracks').fetchone()
+    if total <= BUDGET:
+        return
+    if EVICTION == 'lfu':
+        order = 'COALESCE(hits, 0), COALESCE(last_access, created, 0)'
+    else:
+        order = 'COALESCE(last_access, created, 0)'
+    candidates = connection.execute('SELECT md5, size FROM tracks WHERE md5 IS NOT ? ORDER BY ' + order,
+                                    (keep,)).fetchall()
+    for track_md5, size in candidates:
+        if total <= BUDGET:
+            break
+        LOG.info("Evicting %s from the local database.", track_md5)
+        evict(track_md5)
+        total -= size or 0
@@ -1,9 +1,15 @@
 import os
+import re
 import sys
+import json
 import time
+import errno
 import numpy
 import logging
 import tempfile
+import threading
+import contextlib
+import collections
 import subprocess
 import cStringIO
 from exceptionthread import ExceptionThread
@@ -12,6 +18,121 @@ log = logging.getLogger(__name__)
 
 # Base name of the ffmpeg binary. Can be monkey-patched if desired.
 FFMPEG = 'en-ffmpeg'
+# Base name of the ffprobe binary, used to read the settings of media
+# files. Where it is missing, ffmpeg's description of the file is parsed.
+FFPROBE = 'ffprobe'
+
+# Number of sample frames read from ffmpeg's stdout at a time when
+# decoding straight to memory.
+PCM_CHUNK_FRAMES = 65536
+
+# Most ffmpeg processes that `POOL` runs at once, most callers that may
+# wait for one of them to finish (None for any number), and seconds that
+# a process may run before it is killed (None for no limit).
+MAX_PROCESSES = 4
+MAX_PENDING = None
+TIMEOUT = None
+
+class FFmpegBusyError(RuntimeError):
+    "Raised when too many callers are already waiting to run ffmpeg."
+    pass
+
+class FFmpegTimeoutError(RuntimeError):
+    "Raised when an ffmpeg process was killed for running too long."
+    pass
+
+class FFmpegPool(object):
+    """
+    Runs ffmpeg processes, at most `size` at a time. Further callers wait
+    for a process to finish, unless `max_pending` of them are waiting
+    already, in which case they get an `FFmpegBusyError`. Processes that
+    run for longer than `timeout` seconds are killed, and their callers
+    get an `FFmpegTimeoutError`.
+    """
+    def __init__(self, size=MAX_PROCESSES, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        self.size = size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _acquire(self):
+        if self._slots.acquire(False):
+            return
+        with self._lock:
+            if self.max_pending is not None and self._pending >= self.max_pending:
+                raise FFmpegBusyError("%d ffmpeg jobs are already waiting" % self._pending)
+            self._pending += 1
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    @contextlib.contextmanager
+    def process(self, command, timeout=None, **kwargs):
+        """
+        Once a slot is free, starts `command` with `subprocess.Popen`
+        (passing on `kwargs`) and yields the process. On leaving the block,
+        waits for the process to end, or kills it if the block raised.
+        `timeout` overrides the pool's.
+        """
+        self._acquire()
+        try:
+            (lin, mac, win) = get_os()
+            kwargs.setdefault('close_fds', not win)
+            try:
+                p = subprocess.Popen(command, shell=False, **kwargs)
+            except OSError as e:
+                if e.errno == errno.ENOENT and command[0] == FFMPEG:
+                    raise RuntimeError(ffmpeg_install_instructions)
+                raise
+            if timeout is None:
+                timeout = self.timeout
+            expired = []
+            timer = None
+            if timeout is not None:
+                def expire():
+                    expired.append(True)
+                    _kill(p)
+                timer = threading.Timer(timeout, expire)
+                timer.daemon = True
+                timer.start()
+            try:
+                yield p
+            except:
+                _kill(p)
+                raise
+            finally:
+                p.wait()
+                if timer is not None:
+                    timer.cancel()
+            if expired:
+                raise FFmpegTimeoutError("ffmpeg ran for more than %ss: %s" % (timeout, command))
+        finally:
+            self._slots.release()
+
+    def communicate(self, command, input=None, timeout=None, **kwargs):
+        """
+        Runs `command` to the end, feeding it `input`, and returns its
+        (stdout, stderr).
+        """
+        kwargs.setdefault('stdin', None if input is None else subprocess.PIPE)
+        kwargs.setdefault('stdout', subprocess.PIPE)
+        kwargs.setdefault('stderr', subprocess.PIPE)
+        with self.process(command, timeout, **kwargs) as p:
+            return p.communicate(input)
+
+def _kill(p):
+    try:
+        p.kill()
+    except OSError:  # it already ended
+        pass
+
+# Every ffmpeg process is run through this pool. Replace it to change
+# its limits.
+POOL = FFmpegPool()
 
 def get_os():
     """returns is_linux, is_mac, is_windows"""
@@ -21,25 +142,123 @@ def get_os():
         return True, False, False
     return False, False, True
 
-def ensure_valid(filename):
-    command = "%s -i %s -acodec copy -f null -" % (FFMPEG, filename)
+class MediaInfo(collections.namedtuple('MediaInfo',
+        'duration sampleRate numChannels fps size aspect bitRate')):
+    """
+    The settings of a media file, as read by `probe`: its `duration` in
+    seconds, the `sampleRate` and `numChannels` of its first audio stream,
+    the `fps`, `size` (width, height) and `aspect` (x, y) of its first
+    video stream, and the `bitRate` of that video stream (or of the whole
+    file) in kb/s. Any that are unknown are None.
+    """
+    __slots__ = ()
+
+def probe(filename):
+    """
+    Reads the settings of a media file without decoding it, from ffprobe's
+    JSON description of the file (or ffmpeg's, if there is no ffprobe).
+    Returns a `MediaInfo`, or raises ValueError if the file can't be read.
+    """
     if os.path.getsize(filename) == 0:
         raise ValueError("Input file contains 0 bytes")
+    command = [FFPROBE, "-v", "error", "-print_format", "json",
+               "-show_format", "-show_streams", filename]
+    log.info("Calling ffprobe: %s", command)
+    try:
+        f, e = POOL.communicate(command)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return _probe_with_ffmpeg(filename)
+    try:
+        description = json.loads(f)
+    except ValueError:
+        description = {}
+    if not description.get('streams'):
+        raise ValueError("FFPROBE failed to read the file: %s" % e.strip())
+
+    audio, video = {}, {}
+    for stream in description['streams']:
+        if stream.get('codec_type') == 'audio' and not audio:
+            audio = stream
+        elif stream.get('codec_type') == 'video' and not video:
+            video = stream
+    container = description.get('format', {})
 
+    def number(value, kind=float):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    def ratio(value, separator):
+        try:
+            x, y = map(int, value.split(separator))
+        except (AttributeError, ValueError):
+            return None
+        return (x, y) if x and y else None
+
+    fps = ratio(video.get('avg_frame_rate'), '/') or ratio(video.get('r_frame_rate'), '/')
+    size = None
+    if video.get('width') and video.get('height'):
+        size = (int(video['width']), int(video['height']))
+    bitRate = number(video.get('bit_rate') or container.get('bit_rate'), int)
+    return MediaInfo(duration=number(container.get('duration')),
+                     sampleRate=number(audio.get('sample_rate'), int),
+                     numChannels=number(audio.get('channels'), int),
+                     fps=float(fps[0]) / fps[1] if fps else None,
+                     size=size,
+                     aspect=ratio(video.get('display_aspect_ratio'), ':'),
+                     bitRate=None if bitRate is None else bitRate // 1000)
+
+def _probe_with_ffmpeg(filename):
+    "Reads the settings of a media file from the description ffmpeg prints."
+    command = [FFMPEG, "-i", filename]
     log.info("Calling ffmpeg: %s", command)
-    o = subprocess.call(command.split(),
-                        stdout=open(os.devnull, 'wb'),
-                        stderr=open(os.devnull, 'wb'))
-    if o == 0:
-        return True
-    else:
-        raise ValueError("FFMPEG failed to read the file (%d)" % o)
+    f, e = POOL.communicate(command)
+    audio = re.search(r"Stream #0.*Audio:.*", e)
+    video = re.search(r"Stream #0.*Video:.*", e)
+    if audio is None and video is None:
+        raise ValueError("FFMPEG failed to read the file: %s" % e.strip())
+
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", e)
+    if duration is not None:
+        hours, minutes, seconds = duration.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    sampleRate = numChannels = None
+    if audio is not None:
+        sampleRate, numChannels = settings_from_ffmpeg(audio.group(0))
+    fps = size = aspect = bitRate = None
+    if video is not None:
+        line = video.group(0)
+        match = re.search(r" (\d{2,})x(\d{2,})[ ,]", line)
+        if match is not None:
+            size = tuple(map(int, match.groups()))
+        match = re.search(r"DAR (\d+):(\d+)", line)
+        if match is not None:
+            aspect = tuple(map(int, match.groups()))
+        match = re.search(r"([\d.]+) (?:fps|tbr)", line)
+        if match is not None:
+            fps = float(match.group(1))
+        match = re.search(r"(\d+) kb/s", line)
+        if match is not None:
+            bitRate = int(match.group(1))
+    return MediaInfo(duration, sampleRate, numChannels, fps, size, aspect, bitRate)
+
+def ensure_valid(filename):
+    """
+    Checks that ffmpeg can read audio from a file, by probing it rather
+    than decoding it. Raises ValueError if it can't.
+    """
+    if probe(filename).sampleRate is None:
+        raise ValueError("FFMPEG found no audio in the file")
+    return True
 
 
 def ffmpeg(infile, outfile=None, overwrite=True, bitRate=None,
           numChannels=None, sampleRate=None, verbose=True, lastTry=False):
     """
-    Executes ffmpeg through the shell to convert or read media files.
+    Executes ffmpeg to convert or read media files.
     If passed a file object, give it to FFMPEG via pipe. Otherwise, allow
     FFMPEG to read the file from disk.
 
@@ -76,24 +295,14 @@ def ffmpeg(infile, outfile=None, overwrite=True, bitRate=None,
     if verbose:
         log.info(command)
 
-    (lin, mac, win) = get_os()
-    p = subprocess.Popen(
-            command,
-            shell=False,
-            stdin=(None if filename else subprocess.PIPE),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            close_fds=(not win)
-    )
-
     if filename:
-        f, e = p.communicate()
+        f, e = POOL.communicate(command)
     else:
         try:
             infile.seek(0)
         except:  # if the file is not seekable
             pass
-        f, e = p.communicate(infile.read())
+        f, e = POOL.communicate(command, infile.read())
         try:
             infile.seek(0)
         except:  # if the file is not seekable
@@ -126,6 +335,145 @@ def ffmpeg(infile, outfile=None, overwrite=True, bitRate=None,
         return numpy.frombuffer(f, dtype=numpy.int16).reshape((-1, 2))
 
 
+def ffmpeg_pcm(infile, numChannels=None, sampleRate=None, verbose=True,
+               dtype=numpy.int16, offset=None, duration=None, lastTry=False):
+    """
+    Decodes `infile` (a filename or file-like object) to memory without
+    going through a temporary file. ffmpeg writes raw 16-bit PCM to its
+    stdout, which is read `PCM_CHUNK_FRAMES` frames at a time into a
+    single buffer of type `dtype` that grows geometrically as needed.
+
+    If `offset` and/or `duration` (in seconds) are given, ffmpeg seeks in
+    the input and only decodes that window of it.
+
+    Returns a tuple of (ndarray, sampleRate, numChannels). The ndarray is
+    one-dimensional for mono audio, and has one column per channel otherwise.
+    """
+    start = time.time()
+    numChannels = numChannels or 2
+    sampleRate = sampleRate or 44100
+    filename = None
+    if type(infile) is str or type(infile) is unicode:
+        filename = str(infile)
+
+    command = [FFMPEG]
+    if offset:
+        command.extend(("-ss", "%.6f" % offset))
+    command.extend(("-i", filename or "pipe:0"))
+    if duration is not None:
+        command.extend(("-t", "%.6f" % duration))
+    command.extend(("-f", "s16le", "-acodec", "pcm_s16le",
+                    "-ac", str(numChannels), "-ar", str(sampleRate), "pipe:1"))
+    if verbose:
+        log.info(command)
+
+    def shape(frames):
+        if numChannels == 1:
+            return (frames,)
+        return (frames, numChannels)
+
+    frame_bytes = 2 * numChannels
+    capacity = PCM_CHUNK_FRAMES
+    data = numpy.empty(shape(capacity), dtype=dtype)
+    frames = 0
+    errors = []
+    with POOL.process(command,
+                      stdin=(None if filename else subprocess.PIPE),
+                      stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE) as p:
+        # stderr (and stdin, for file-like input) are serviced on other threads
+        # so that ffmpeg never blocks on a full pipe while we read its output.
+        threads = [ExceptionThread(target=lambda: errors.append(p.stderr.read()))]
+        if not filename:
+            def feed():
+                try:
+                    infile.seek(0)
+                except:  # if the file is not seekable
+                    pass
+                try:
+                    p.stdin.write(infile.read())
+                except IOError:  # ffmpeg gave up early; its stderr says why
+                    pass
+                p.stdin.close()
+            threads.append(ExceptionThread(target=feed))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            raw = p.stdout.read(PCM_CHUNK_FRAMES * frame_bytes)
+            if not raw:
+                break
+            count = len(raw) // frame_bytes
+            if frames + count > capacity:
+                capacity = max(capacity * 2, frames + count)
+                data.resize(shape(capacity), refcheck=False)
+            chunk = numpy.frombuffer(raw, dtype="<h", count=count * numChannels)
+            data[frames:frames + count] = chunk.reshape(shape(count))
+            frames += count
+        for thread in threads:
+            thread.join()
+    e = errors[0] if errors else ''
+
+    if 'Could not find codec parameters' in e and not filename and not lastTry:
+        log.warning("FFMPEG couldn't find codec parameters - writing to temp file.")
+        fd, name = tempfile.mkstemp('.audio')
+        handle = os.fdopen(fd, 'w')
+        infile.seek(0)
+        handle.write(infile.read())
+        handle.close()
+        r = ffmpeg_pcm(name, numChannels=numChannels, sampleRate=sampleRate,
+                       verbose=verbose, dtype=dtype, offset=offset,
+                       duration=duration, lastTry=True)
+        log.info("Unlinking temp file at %s...", name)
+        os.unlink(name)
+        return r
+
+    ffmpeg_error_check(e)
+    data.resize(shape(frames), refcheck=False)
+    log.info("Decoded %d frames in %ss.", frames, (time.time() - start))
+    return data, sampleRate, numChannels
+
+
+def ffmpeg_encode(chunks, outfile, numChannels=2, sampleRate=44100,
+                  bitRate=None, verbose=True):
+    """
+    Encodes raw PCM to `outfile` without an intermediate wave file.
+    `chunks` is an iterable of 16-bit sample arrays, which are written to
+    ffmpeg's stdin as they are produced, so callers can generate (or
+    convert) one chunk at a time.
+
+    Returns the sampling frequency and number of channels of the output file.
+    """
+    start = time.time()
+    command = [FFMPEG, "-f", "s16le", "-ac", str(numChannels),
+               "-ar", str(sampleRate), "-i", "pipe:0", "-y"]
+    if bitRate is not None:
+        command.extend(("-ab", str(bitRate) + "k"))
+    command.append(outfile)
+    if verbose:
+        log.info(command)
+
+    errors = []
+    with open(os.devnull, 'wb') as devnull:
+        with POOL.process(command, stdin=subprocess.PIPE, stdout=devnull,
+                          stderr=subprocess.PIPE) as p:
+            reader = ExceptionThread(target=lambda: errors.append(p.stderr.read()))
+            reader.start()
+            try:
+                for chunk in chunks:
+                    p.stdin.write(numpy.ascontiguousarray(chunk, dtype="<h").tostring())
+            except IOError:  # ffmpeg gave up early; its stderr says why
+                pass
+            finally:
+                p.stdin.close()
+            reader.join()
+    e = errors[0] if errors else ''
+
+    ffmpeg_error_check(e)
+    log.info("Encoded in %ss.", (time.time() - start))
+    return settings_from_ffmpeg(e)
+
+
 def ffmpeg_downconvert(infile, lastTry=False):
     """
     Downconvert the given filename (or file-like) object to 32kbps MP3 for analysis.
@@ -137,25 +485,14 @@ def ffmpeg_downconvert(infile, lastTry=False):
     if type(infile) is str or type(infile) is unicode:
         filename = str(infile)
 
-    command = FFMPEG \
-            + (" -i \"%s\"" % infile if filename else " -i pipe:0") \
-            + " -b 32k -f mp3 pipe:1"
+    command = [FFMPEG, "-i", filename or "pipe:0", "-b", "32k", "-f", "mp3", "pipe:1"]
     log.info("Calling ffmpeg: %s", command)
 
-    (lin, mac, win) = get_os()
-    p = subprocess.Popen(
-        command,
-        shell=True,
-        stdin=(None if filename else subprocess.PIPE),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        close_fds=(not win)
-    )
     if filename:
-        f, e = p.communicate()
+        f, e = POOL.communicate(command)
     else:
         infile.seek(0)
-        f, e = p.communicate(infile.read())
+        f, e = POOL.communicate(command, infile.read())
         infile.seek(0)
 
     if 'Could not find codec parameters' in e and not lastTry:
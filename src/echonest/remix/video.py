@@ -18,6 +18,8 @@ import sys
 import tempfile
 import logging
 from echonest.remix import audio
+from echonest.remix.support import ffmpeg
+from echonest.remix.local_db import file_info
 from pyechonest import config
 
 log = logging.getLogger(__name__)
@@ -153,6 +155,10 @@ class VideoSettings():
             cmd += " -aspect "+str(self.aspect[0])+":"+str(self.aspect[1])
         return cmd
 
+    def arguments(self):
+        "format as a list of ffmpeg arguments"
+        return str(self).split()
+
     def imageformat(self):
         "return a string indicating to PIL the image format"
         if self.uncompressed:
@@ -201,12 +207,13 @@ class SynchronizedAV():
 
 
 def loadav(videofile, verbose=True):
+    if file_info(videofile).sampleRate is None:
+        raise ValueError("%s has no audio track" % videofile)
     foo, audio_file = tempfile.mkstemp(".mp3")        
-    cmd = "en-ffmpeg -y -i \"" + videofile + "\" " + audio_file
+    cmd = [ffmpeg.FFMPEG, "-y", "-i", videofile, audio_file]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    res = out.communicate()
+    res = ffmpeg.POOL.communicate(cmd)
     ffmpeg_error_check(res[1])
     a = audio.LocalAudioFile(audio_file)
     v = sequencefrommov(videofile)
@@ -232,11 +239,11 @@ def loadavfromyoutube(url, verbose=True):
     #todo: cache youtube videos?
     foo, yt_file = tempfile.mkstemp()        
     # https://github.com/rg3/youtube-dl/
-    cmd = "youtube-dl -o " + "temp.video" + " " + url
+    cmd = ["youtube-dl", "-o", "temp.video", url]
     if verbose:
         log.info(cmd)
     log.info("Downloading video...")
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     (res, err) = out.communicate()
 
     # hack around the /tmp/ issue
@@ -250,10 +257,10 @@ def youtubedl(url, verbose=True):
     """downloads a video from youtube and returns the file object"""
     foo, yt_file = tempfile.mkstemp()        
     # https://github.com/rg3/youtube-dl/
-    cmd = "youtube-dl -o " + yt_file + " " + url
+    cmd = ["youtube-dl", "-o", yt_file, url]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     res = out.communicate()
     return yt_file
 
@@ -271,10 +278,10 @@ def sequencefromyoutube(url, settings=None, dir=None, pre="frame-", verbose=True
     #todo: cache youtube videos?
     foo, yt_file = tempfile.mkstemp()
     # http://bitbucket.org/rg3/youtube-dl
-    cmd = "youtube-dl -o " + yt_file + " " + url
+    cmd = ["youtube-dl", "-o", yt_file, url]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out.communicate()
     return sequencefrommov(yt_file, settings, dir, pre)
 
@@ -301,13 +308,12 @@ def sequencefrommov(mov, settings=None, direc=None, pre="frame-", verbose=True):
     format = "jpeg"
     if settings is not None:
         format = settings.imageformat()
-    cmd = "en-ffmpeg -i " + mov + " -an -sameq " + os.path.join(direc, pre + "%06d." + format)
+    cmd = [ffmpeg.FFMPEG, "-i", mov, "-an", "-sameq", os.path.join(direc, pre + "%06d." + format)]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    res = out.communicate()
+    res = ffmpeg.POOL.communicate(cmd)
     ffmpeg_error_check(res[1])
-    settings = settingsfromffmpeg(res[1])
+    settings = settingsfrominfo(file_info(mov))
     seq =  sequencefromdir(direc, format, settings)
     return seq
 
@@ -316,14 +322,13 @@ def sequencetomovie(outfile, seq, audio=None, verbose=True):
     "renders sequence to a movie file, perhaps with an audio track"
     direc = tempfile.mkdtemp()
     seq.render(direc, "image-", False)
-    cmd = "en-ffmpeg -y " + str(seq.settings) + " -i " + os.path.join(direc, "image-%06d." + seq.settings.imageformat())
+    cmd = [ffmpeg.FFMPEG, "-y"] + seq.settings.arguments() + ["-i", os.path.join(direc, "image-%06d." + seq.settings.imageformat())]
     if audio:
-        cmd += " -i " + audio
-    cmd += " -sameq " + outfile
+        cmd += ["-i", audio]
+    cmd += ["-sameq", outfile]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    res = out.communicate()
+    res = ffmpeg.POOL.communicate(cmd)
     ffmpeg_error_check(res[1])
 
 
@@ -340,15 +345,25 @@ def convertmov(infile, outfile=None, settings=None, verbose=True):
         raise TypeError("settings arg must be a VideoSettings object")
     if outfile is None:
         foo, outfile = tempfile.mkstemp(".flv")
-    cmd = "en-ffmpeg -y -i " + infile + " " + str(settings) + " -sameq " + outfile
+    cmd = [ffmpeg.FFMPEG, "-y", "-i", infile] + settings.arguments() + ["-sameq", outfile]
     if verbose:
         log.info(cmd)
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    res = out.communicate()
+    res = ffmpeg.POOL.communicate(cmd)
     ffmpeg_error_check(res[1])
     return outfile
 
 
+def settingsfrominfo(info):
+    """takes the MediaInfo of a video file (see local_db.file_info) and
+    returns a VideoSettings object mimicking the input video"""
+    settings = VideoSettings()
+    settings.fps = info.fps
+    settings.size = info.size
+    settings.aspect = info.aspect
+    settings.bitrate = info.bitRate
+    return settings
+
+
 def settingsfromffmpeg(parsestring):
     """takes ffmpeg output and returns a VideoSettings object mimicking
     the input video"""
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test that an analysis written by AudioAnalysis.save reads back the same,
+including the missing (None or NaN) values of old or partial analyses.
+
+Run the tests like this:
+    python test_analysis.py
+"""
+
+import os
+import tempfile
+
+import numpy
+
+from echonest.remix import audio
+
+class _Track(object):
+    """The parts of a pyechonest track that AudioAnalysis reads, with a
+    small made-up analysis."""
+    md5 = '0123456789abcdef0123456789abcdef'
+    bars = [{'start': 0.5, 'confidence': 0.9},
+            {'start': 2.5, 'confidence': 0.4},
+            {'start': 4.5, 'confidence': 0.6}]
+    beats = [{'start': 0.5 * i, 'confidence': None if i == 1 else 0.1 * i}
+             for i in range(8)]
+    tatums = [{'start': 0.25 * i, 'confidence': 0.5} for i in range(16)]
+    sections = [{'start': 0.0, 'duration': 2.0, 'confidence': 1.0, 'key': 5,
+                 'key_confidence': 0.5, 'mode': 1, 'mode_confidence': 0.25,
+                 'tempo': 120.0, 'tempo_confidence': 0.75, 'time_signature': 4,
+                 'time_signature_confidence': 1.0, 'loudness': -8.5},
+                # An old analysis, without most of the section attributes.
+                {'start': 2.0, 'duration': 2.0, 'confidence': 0.5, 'loudness': -9.0}]
+    segments = [{'start': 0.3 * i, 'duration': 0.3, 'confidence': 0.5,
+                 'pitches': [(i + j) / 24. for j in range(12)],
+                 'timbre': [i * j - 20. for j in range(12)],
+                 'loudness_start': -30. + i, 'loudness_max': -10. + i,
+                 'loudness_max_time': 0.05 * i,
+                 'loudness_end': None if i == 2 else -20. - i}
+                for i in range(5)]
+
+def make_analysis():
+    analysis = audio.AudioAnalysis.__new__(audio.AudioAnalysis)
+    analysis.pyechonest_track = _Track()
+    analysis.source = None
+    analysis._tables = {}
+    analysis._bars = None
+    analysis._beats = None
+    analysis._tatums = None
+    analysis._sections = None
+    analysis._segments = None
+    analysis.identifier = 'TRABCDE1234567890'
+    analysis.metadata = {'artist': 'nobody', 'bitrate': 128}
+    analysis.synchstring = u'synch ♫'
+    analysis.codestring = 'code'
+    analysis.rhythmstring = None
+    for attribute in ('time_signature', 'mode', 'tempo', 'key'):
+        setattr(analysis, attribute, {'value': 4, 'confidence': 0.5})
+    analysis.end_of_fade_in = 0.1
+    analysis.start_of_fade_out = 4.0
+    analysis.duration = 4.6
+    analysis.loudness = -9.5
+    return analysis
+
+def assert_same_column(expected, actual):
+    if expected.dtype == object or actual.dtype == object:
+        assert expected.tolist() == actual.tolist(), (expected, actual)
+        return
+    assert expected.shape == actual.shape, (expected.shape, actual.shape)
+    missing = numpy.isnan(expected)
+    assert (missing == numpy.isnan(actual)).all(), (expected, actual)
+    assert numpy.allclose(expected[~missing], actual[~missing]), (expected, actual)
+
+def round_trip(analysis):
+    handle, path = tempfile.mkstemp('.analysis')
+    os.close(handle)
+    try:
+        analysis.save(path)
+        loaded = audio.AudioAnalysis(path, fromLocal=True)
+        # Read the lazy strings while the file is still there.
+        strings = [getattr(loaded, name) for name in audio.AudioAnalysis.STRINGS]
+    finally:
+        os.remove(path)
+    return loaded, strings
+
+def test_tables_round_trip():
+    analysis = make_analysis()
+    loaded, strings = round_trip(analysis)
+    for kind in audio.AudioAnalysis.KINDS:
+        expected = analysis.table(kind)
+        actual = loaded.table(kind)
+        assert sorted(expected.columns) == sorted(actual.columns), kind
+        for name in expected.columns:
+            assert_same_column(expected.columns[name], actual.columns[name])
+
+def test_header_and_strings_round_trip():
+    analysis = make_analysis()
+    loaded, strings = round_trip(analysis)
+    assert loaded.identifier == analysis.identifier
+    for attribute in audio.AudioAnalysis.HEADER:
+        assert getattr(loaded, attribute) == getattr(analysis, attribute), attribute
+    assert strings == [u'synch ♫', u'code', None]
+
+def test_quanta_round_trip():
+    loaded, strings = round_trip(make_analysis())
+    assert len(loaded.bars) == 3 and len(loaded.tatums) == 16
+    assert loaded.beats[1].confidence is None
+    assert abs(loaded.beats[2].confidence - 0.2) < 1e-9
+    first, second = loaded.sections
+    assert (first.key, first.mode, first.time_signature) == (5, 1, 4)
+    assert first.tempo == 120.0 and first.loudness == -8.5
+    assert second.key is None and second.mode is None and second.tempo is None
+    assert second.time_signature is None and second.loudness == -9.0
+    segment = loaded.segments[3]
+    assert numpy.allclose(segment.pitches, [(3 + j) / 24. for j in range(12)])
+    assert numpy.allclose(segment.timbre, [3 * j - 20. for j in range(12)])
+    assert numpy.isnan(loaded.table('segment').loudness_end[2])
+
+def main():
+    """Run some tests"""
+    test_tables_round_trip()
+    test_header_and_strings_round_trip()
+    test_quanta_round_trip()
+    print 'Ok!'
+
+if __name__ == '__main__':
+    main()
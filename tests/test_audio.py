@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test AudioData's in-memory sample rate and channel conversions.
+
+Run the tests like this:
+    python test_audio.py
+"""
+
+import numpy
+
+from echonest.remix import audio
+
+def make_audio(data, sampleRate=44100):
+    data = numpy.asarray(data, dtype=numpy.int16)
+    numChannels = 1 if data.ndim == 1 else data.shape[1]
+    return audio.AudioData(ndarray=data, sampleRate=sampleRate,
+                           numChannels=numChannels, defer=False)
+
+def sine(frequency, sampleRate, frames, amplitude=10000.):
+    return amplitude * numpy.sin(2 * numpy.pi * frequency * numpy.arange(frames) / float(sampleRate))
+
+def test_resampled_length():
+    for frames in (1, 147, 1000, 44100):
+        out = make_audio(numpy.zeros(frames)).resampled(48000)
+        assert out.sampleRate == 48000
+        # 48000 / 44100 = 160 / 147, rounded up.
+        assert len(out.data) == -(-frames * 160 // 147), (frames, len(out.data))
+    out = make_audio(numpy.zeros((1000, 2))).resampled(22050)
+    assert out.data.shape == (500, 2) and out.numChannels == 2
+
+def test_resampled_dc_gain():
+    out = make_audio(numpy.ones(44100) * 1000).resampled(48000)
+    # Away from the edges, where the filter runs off the signal.
+    middle = out.data[1000:-1000]
+    assert numpy.abs(middle - 1000).max() <= 10, numpy.abs(middle - 1000).max()
+
+def test_resampled_sine():
+    source = make_audio(numpy.round(sine(1000, 44100, 44100)))
+    out = source.resampled(48000)
+    expected = sine(1000, 48000, len(out.data))
+    error = numpy.abs(out.data[1000:-1000] - expected[1000:-1000]).max()
+    assert error < 100, error
+
+def test_resampled_is_writable():
+    out = make_audio(numpy.zeros(1000)).resampled(48000)
+    out.data[:10] *= 2
+
+def test_upmix():
+    mono = make_audio([0, 100, -200, 300])
+    stereo = mono.with_channels(2)
+    assert stereo.numChannels == 2 and stereo.data.shape == (4, 2)
+    assert (stereo.data[:, 0] == mono.data).all() and (stereo.data[:, 1] == mono.data).all()
+    three = make_audio([[1, 2], [3, 4]]).with_channels(3)
+    # Channels are repeated in turn.
+    assert three.data.tolist() == [[1, 2, 1], [3, 4, 3]]
+
+def test_downmix():
+    stereo = make_audio([[100, 300], [-100, -300], [0, 1000]])
+    mono = stereo.with_channels(1)
+    assert mono.numChannels == 1 and mono.data.ndim == 1
+    assert mono.data.tolist() == [200, -200, 500]
+    quad = make_audio([[1, 10, 3, 30], [5, 50, 7, 70]])
+    # Channels that fold onto the same output channel are averaged.
+    assert quad.with_channels(2).data.tolist() == [[2, 20], [6, 60]]
+
+def test_downmix_is_writable():
+    mono = make_audio([[100, 300], [-100, -300]]).with_channels(1)
+    mono.data[0:1] *= 2
+    assert mono.data.tolist() == [400, -200]
+
+def main():
+    """Run some tests"""
+    test_resampled_length()
+    test_resampled_dc_gain()
+    test_resampled_sine()
+    test_resampled_is_writable()
+    test_upmix()
+    test_downmix()
+    test_downmix_is_writable()
+    print 'Ok!'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test that the text track list of an old local db is moved into the
+sqlite index.
+
+Run the tests like this:
+    python test_local_db.py
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from echonest.remix import local_db
+
+OLD_MD5S = ['0123456789abcdef0123456789abcdef', 'fedcba9876543210fedcba9876543210']
+PATHS = ('REMIX_FOLDER', 'AUDIO_FOLDER', 'ANALYSIS_FOLDER', 'INDEX', 'DATABASE')
+
+def in_temporary_db(test):
+    "Runs `test` with the local db in a new temporary folder."
+    def fun():
+        saved = dict((name, getattr(local_db, name)) for name in PATHS)
+        folder = tempfile.mkdtemp()
+        local_db.REMIX_FOLDER = folder
+        local_db.AUDIO_FOLDER = os.path.join(folder, 'audio')
+        local_db.ANALYSIS_FOLDER = os.path.join(folder, 'analysis')
+        local_db.INDEX = os.path.join(folder, 'index.sqlite')
+        local_db.DATABASE = os.path.join(folder, 'database.db')
+        local_db._local.connection = None
+        try:
+            test()
+        finally:
+            if local_db._local.connection is not None:
+                local_db._local.connection.close()
+                local_db._local.connection = None
+            for name, value in saved.items():
+                setattr(local_db, name, value)
+            shutil.rmtree(folder)
+    fun.__name__ = test.__name__
+    return fun
+
+def write_old_database():
+    with open(local_db.DATABASE, 'w') as db_file:
+        for md5 in OLD_MD5S:
+            db_file.write(md5 + '\n')
+
+def indexed_tracks():
+    return sorted(str(row[0]) for row in local_db._connect().execute('SELECT md5 FROM tracks'))
+
+@in_temporary_db
+def test_migrate_old_database():
+    write_old_database()
+    local_db.check_and_create_local_db()
+    assert indexed_tracks() == OLD_MD5S
+    assert not os.path.exists(local_db.DATABASE)
+    assert os.path.exists(local_db.DATABASE + '.old')
+    assert all(local_db.check_db(md5) for md5 in OLD_MD5S)
+    # Running it again finds nothing more to move.
+    local_db.check_and_create_local_db()
+    assert indexed_tracks() == OLD_MD5S
+
+@in_temporary_db
+def test_migrate_into_old_index():
+    # An index from before the tracks table had its other columns.
+    connection = sqlite3.connect(local_db.INDEX)
+    connection.execute('CREATE TABLE tracks (md5 TEXT PRIMARY KEY, created REAL)')
+    connection.execute('INSERT INTO tracks VALUES (?, ?)', ('00' * 16, 0.0))
+    connection.commit()
+    connection.close()
+    write_old_database()
+    local_db.check_and_create_local_db()
+    assert indexed_tracks() == sorted(OLD_MD5S + ['00' * 16])
+    columns = [row[1] for row in local_db._connect().execute('PRAGMA table_info(tracks)')]
+    assert columns == [name for name, kind in local_db.COLUMNS]
+
+def main():
+    """Run some tests"""
+    test_migrate_old_database()
+    test_migrate_into_old_index()
+    print 'Ok!'
+
+if __name__ == '__main__':
+    main()
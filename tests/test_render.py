@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Test that rendering through a RenderPlan gives exactly the samples that
+rendering the tree recursively, one source at a time, does.
+
+Run the tests like this:
+    python test_render.py
+"""
+
+import numpy
+
+from echonest.remix import audio
+from echonest.remix.audio import AudioQuantum, AudioQuantumList, Simultaneous
+from echonest.remix.audio import AmplitudeFactor, LevelDB, TimeTruncateFactor, TimeTruncateLength
+
+# A power of two, so that the quanta below fall on whole frames.
+RATE = 1024
+
+def make_source(seconds, numChannels, seed, sampleRate=RATE):
+    random = numpy.random.RandomState(seed)
+    shape = (seconds * sampleRate, numChannels) if numChannels > 1 else (seconds * sampleRate,)
+    data = random.randint(-8000, 8000, size=shape).astype(numpy.int16)
+    return audio.AudioData(ndarray=data, sampleRate=sampleRate, numChannels=numChannels, defer=False)
+
+STEREO = make_source(4, 2, 0)
+MONO = make_source(3, 1, 1)
+# At half the rate of the others, so it is resampled when mixed with them.
+SLOW = make_source(2, 2, 3, sampleRate=RATE // 2)
+
+def quanta(source, *times):
+    return [AudioQuantum(start, duration, 'beat', 1.0, source) for start, duration in times]
+
+def recursive_render(renderable):
+    "Renders the way `AudioQuantumList.render` did before render plans."
+    first = list.__getitem__(renderable, 0).source
+    if isinstance(renderable, Simultaneous):
+        frames = int(max(renderable.durations) * first.sampleRate)
+    else:
+        frames = sum(int(aq.duration * first.sampleRate) for aq in list.__iter__(renderable))
+    to_audio = renderable.init_audio_data(first, frames)
+    for source in renderable.sources():
+        renderable.render(start=0.0, to_audio=to_audio, with_source=source)
+    return to_audio
+
+def assert_renders_alike(renderable):
+    expected = recursive_render(renderable)
+    actual = renderable.render()
+    assert expected.data.shape == actual.data.shape, (expected.data.shape, actual.data.shape)
+    assert (expected.data == actual.data).all()
+
+def test_back_to_back_runs():
+    # The first three carry straight on from each other, and are coalesced.
+    run = quanta(STEREO, (0.25, 0.25), (0.5, 0.25), (0.75, 0.5), (2.0, 0.125), (2.125, 0.125))
+    assert_renders_alike(AudioQuantumList(run))
+    assert len(audio.RenderPlan.compile(AudioQuantumList(run), RATE).ops) == 2
+
+def test_repeats_and_overlaps():
+    beats = quanta(STEREO, (1.0, 0.5), (1.0, 0.5), (0.75, 0.5), (3.875, 0.5))
+    assert_renders_alike(AudioQuantumList(beats))
+
+def test_several_sources():
+    beats = []
+    for stereo, mono in zip(quanta(STEREO, (0.0, 0.5), (0.5, 0.5), (1.0, 0.25)),
+                            quanta(MONO, (2.0, 0.25), (0.125, 0.375), (2.75, 0.5))):
+        beats.extend([stereo, mono])
+    assert_renders_alike(AudioQuantumList(beats))
+
+def test_mixed_rates():
+    run = quanta(SLOW, (0.25, 0.25), (0.5, 0.25), (0.75, 0.5))
+    beats = AudioQuantumList(quanta(STEREO, (0.0, 0.25)) + run + quanta(STEREO, (0.25, 0.25)))
+    assert_renders_alike(beats)
+    # Pieces to be resampled are not joined, even when back to back.
+    ops = audio.RenderPlan.compile(beats, RATE).ops
+    assert len([op for op in ops if op.source is SLOW]) == 3
+    assert_renders_alike(AudioQuantumList([AmplitudeFactor(2)(q) for q in run]))
+    # The second piece carries on from the first in SLOW, and starts as many
+    # output frames in as the first is long in SLOW's frames. They still
+    # must not be joined: the first lasts half a second, the gap a quarter.
+    gap = STEREO[0.0:0.25]
+    first, second = quanta(SLOW, (0.0, 0.5), (0.5, 0.25))
+    stack = Simultaneous(quanta(STEREO, (1.0, 0.75)) + [first, AudioQuantumList([gap, second])])
+    assert_renders_alike(stack)
+    assert len(audio.RenderPlan.compile(stack, RATE).ops) == 3
+
+def test_nested():
+    inner = AudioQuantumList(quanta(MONO, (0.5, 0.25), (0.75, 0.25)))
+    stack = Simultaneous(quanta(STEREO, (1.0, 0.5), (2.0, 0.25)) + quanta(MONO, (0.0, 0.75)))
+    deeper = AudioQuantumList([AudioQuantumList(quanta(STEREO, (3.0, 0.125))), stack])
+    outer = AudioQuantumList(quanta(STEREO, (0.0, 0.25)) + [inner, stack, deeper])
+    assert_renders_alike(outer)
+    assert_renders_alike(stack)
+
+def test_effects():
+    stereo = quanta(STEREO, (0.0, 0.5), (0.5, 0.5), (1.0, 0.5), (1.5, 0.5), (2.0, 0.5), (2.5, 0.5))
+    mono = quanta(MONO, (1.0, 0.5), (1.5, 0.5))
+    beats = AudioQuantumList([
+        AmplitudeFactor(2)(stereo[0]),
+        LevelDB(-6)(stereo[1]),
+        TimeTruncateFactor(0.5)(stereo[2]),
+        TimeTruncateLength(0.75)(stereo[3]),
+        LevelDB(-3)(AmplitudeFactor(0.5)(TimeTruncateFactor(1.5)(stereo[4]))),
+        stereo[5],
+        AmplitudeFactor(3)(mono[0]),
+        mono[1],
+    ])
+    assert_renders_alike(beats)
+    assert_renders_alike(Simultaneous(list(beats)))
+
+def modify_in_turn(adata, effects):
+    """
+    The samples of `adata` passed through each effect's own `modify` in
+    turn, the way pieces were rendered before effects were fused. They are
+    kept as floats between effects, as numpy no longer scales int32s by a
+    float in place.
+    """
+    piece = audio.AudioData32(ndarray=adata.data, sampleRate=adata.sampleRate,
+                              numChannels=adata.numChannels, defer=False)
+    for effect in effects:
+        piece.data = piece.data.astype(numpy.float64)
+        piece = effect.modify(piece)
+    return piece.data
+
+# Chains of whole-number gains, which give exactly the same samples either way.
+EXACT_CHAINS = [
+    (AmplitudeFactor(2), TimeTruncateFactor(0.5), AmplitudeFactor(3)),
+    (AmplitudeFactor(2), AmplitudeFactor(-3)),
+    (AmplitudeFactor(3), TimeTruncateLength(0.3), AmplitudeFactor(-1), TimeTruncateFactor(1.5)),
+    (TimeTruncateFactor(1.5), AmplitudeFactor(2), TimeTruncateLength(0.25)),
+    (TimeTruncateLength(0.75), TimeTruncateFactor(0.5), AmplitudeFactor(2), AmplitudeFactor(2)),
+]
+# Chains of fractional gains, which fusing rounds once instead of after each.
+ROUNDED_CHAINS = [
+    (LevelDB(-6), TimeTruncateFactor(0.5), AmplitudeFactor(0.5)),
+    (AmplitudeFactor(0.5), LevelDB(3)),
+    (LevelDB(-3), TimeTruncateLength(0.2), LevelDB(-3), TimeTruncateFactor(1.25)),
+]
+
+def assert_matches_modify(source, quantum, effects, tolerance):
+    expected = modify_in_turn(source[quantum], effects)
+    modified = audio.ModifiedRenderable(quantum, list(effects))
+    pieces = [audio._apply_effects(source[quantum], effects).data,
+              modified.render().data,
+              AudioQuantumList([modified]).render().data]
+    for actual in pieces:
+        assert len(actual) >= len(expected), (effects, len(actual), len(expected))
+        assert numpy.abs(actual[:len(expected)] - expected).max() <= tolerance, effects
+        assert not actual[len(expected):].any(), effects
+
+def test_fused_effects_match_modify():
+    for source, quantum in ((STEREO, quanta(STEREO, (0.5, 0.5))[0]), (MONO, quanta(MONO, (1.0, 0.5))[0])):
+        for effects in EXACT_CHAINS:
+            assert_matches_modify(source, quantum, effects, 0)
+        for effects in ROUNDED_CHAINS:
+            assert_matches_modify(source, quantum, effects, 1)
+    # A gain for each channel stops the fusing; the rest are modified in turn.
+    beat = quanta(STEREO, (0.5, 0.5))[0]
+    assert_matches_modify(STEREO, beat, (AmplitudeFactor(2), AmplitudeFactor((1, 0)),
+                                         TimeTruncateFactor(0.5), AmplitudeFactor(3)), 0)
+
+def test_gains():
+    run = quanta(STEREO, (0.5, 0.25), (0.75, 0.25), (1.0, 0.5), (3.0, 0.25))
+    louder = AudioQuantumList([LevelDB(-3)(AmplitudeFactor(2)(q)) for q in run])
+    assert_renders_alike(louder)
+    # Gains alone go in the operations, and back-to-back ones are joined.
+    ops = audio.RenderPlan.compile(louder, RATE).ops
+    assert len(ops) == 2 and not any(op.effects for op in ops)
+    mixed = AudioQuantumList(louder + [AmplitudeFactor(2)(q) for q in quanta(MONO, (0.0, 0.5))])
+    assert_renders_alike(mixed)
+
+def test_per_channel_gains():
+    # The pan idiom: a gain for each channel, as a tuple or an array.
+    beats = quanta(STEREO, (0.0, 0.5), (0.5, 0.5), (1.0, 0.5))
+    panned = AudioQuantumList([
+        AmplitudeFactor((1, 0))(beats[0]),
+        AmplitudeFactor(numpy.array([0, 2]))(beats[1]),
+        AmplitudeFactor(2)(AmplitudeFactor((0, 1))(beats[2])),
+    ])
+    assert_renders_alike(panned)
+    data = panned.render().data
+    half = RATE // 2
+    assert (data[:half, 0] == STEREO.data[:half, 0]).all() and not data[:half, 1].any()
+    assert not data[half:RATE, 0].any() and (data[half:RATE, 1] == 2 * STEREO.data[half:RATE, 1]).all()
+    assert not data[RATE:, 0].any() and (data[RATE:, 1] == 2 * STEREO.data[RATE:RATE + half, 1]).all()
+
+def test_cache_sees_new_samples():
+    source = make_source(1, 2, 2)
+    louder = AudioQuantumList([AmplitudeFactor(2)(q) for q in quanta(source, (0.0, 0.5))])
+    assert (louder.render().data == source.data[:RATE // 2] * 2).all()
+    source.data = source.data // 2
+    assert (louder.render().data == source.data[:RATE // 2] * 2).all()
+    # Changes made in place need the cache cleared.
+    source.data[:] = 0
+    audio.RENDER_CACHE.clear()
+    assert not louder.render().data.any()
+
+def test_sources_follow_changes():
+    inner = AudioQuantumList(quanta(STEREO, (0.0, 0.5)))
+    outer = AudioQuantumList([inner, AmplitudeFactor(2)(AudioQuantumList([inner]))])
+    other = AudioQuantumList(quanta(STEREO, (1.0, 0.5)))
+    assert outer.sources() == other.sources() == set([STEREO])
+    kept = other._sources
+    inner.append(quanta(MONO, (0.0, 0.5))[0])
+    assert outer.sources() == set([STEREO, MONO])
+    # Lists that don't hold the changed one keep their sources.
+    assert other.sources() == set([STEREO]) and other._sources is kept
+    inner.pop()
+    assert outer.sources() == set([STEREO])
+
+    # Quanta of an analysis take its source.
+    analysis = audio.AudioAnalysis.__new__(audio.AudioAnalysis)
+    beat = AudioQuantum(0.0, 0.5, 'beat', 1.0)
+    beat.container = analysis
+    beats = AudioQuantumList([beat])
+    analysis.source = STEREO
+    assert beats.sources() == set([STEREO])
+    analysis.source = MONO
+    assert beats.sources() == set([MONO])
+
+def main():
+    """Run some tests"""
+    test_back_to_back_runs()
+    test_repeats_and_overlaps()
+    test_several_sources()
+    test_mixed_rates()
+    test_nested()
+    test_effects()
+    test_fused_effects_match_modify()
+    test_gains()
+    test_per_channel_gains()
+    test_cache_sees_new_samples()
+    test_sources_follow_changes()
+    print 'Ok!'
+
+if __name__ == '__main__':
+    main()